@@ -0,0 +1,206 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+DEFAULT_STORE_PATH = os.path.join("generated_scripts", "artifacts.sqlite3")
+LIST_LIMIT = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    spec_hash TEXT NOT NULL,
+    specification TEXT NOT NULL,
+    output_folder TEXT NOT NULL,
+    passed INTEGER NOT NULL,
+    attempts INTEGER NOT NULL,
+    model TEXT,
+    created_at REAL NOT NULL,
+    duration_seconds REAL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    cost_usd REAL,
+    stage_seconds TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_spec_hash ON runs (spec_hash, passed, created_at);
+CREATE INDEX IF NOT EXISTS runs_created_at ON runs (created_at);
+CREATE TABLE IF NOT EXISTS artifacts (
+    run_id INTEGER PRIMARY KEY REFERENCES runs (id),
+    input_schema TEXT,
+    output_schema TEXT,
+    unit_tests TEXT,
+    final_script TEXT
+);
+"""
+RUN_COLUMNS = [
+    "id", "spec_hash", "specification", "output_folder", "passed", "attempts", "model", "created_at",
+    "duration_seconds", "prompt_tokens", "completion_tokens", "cost_usd", "stage_seconds",
+]
+ARTIFACT_COLUMNS = ["input_schema", "output_schema", "unit_tests", "final_script"]
+
+
+def normalize_spec(specification):
+    # case, unicode forms and whitespace do not make two specifications different
+    text = unicodedata.normalize("NFKC", specification).casefold()
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def spec_hash(specification):
+    return hashlib.sha256(normalize_spec(specification).encode()).hexdigest()
+
+
+def _run_record(row):
+    record = dict(zip(RUN_COLUMNS, row))
+    record["passed"] = bool(record["passed"])
+    record["stage_seconds"] = json.loads(record["stage_seconds"] or "{}")
+    return record
+
+
+class ArtifactStore:
+    # SQLite index of every generated script: run metadata in one table for fast listing,
+    # schemas, tests and the final script in another. The database is opened on first use,
+    # with one connection per thread.
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        # "use" reuses passing scripts and records runs, "refresh" only records, "bypass" does neither
+        self.mode = "use"
+        self.reused = 0
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            # WAL lets batch workers and the server read while another thread writes
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with self._schema_lock:
+                if not self._schema_ready:
+                    connection.executescript(SCHEMA)
+                    self._schema_ready = True
+            self._local.connection = connection
+        return connection
+
+    def record(self, specification, output_folder, passed, attempts, artifacts, model=None, duration_seconds=None, prompt_tokens=None, completion_tokens=None, cost_usd=None, stage_seconds=None):
+        connection = self._connection()
+        with connection:
+            cursor = connection.execute(
+                "INSERT INTO runs (spec_hash, specification, output_folder, passed, attempts, model, created_at, "
+                "duration_seconds, prompt_tokens, completion_tokens, cost_usd, stage_seconds) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    spec_hash(specification), specification, output_folder, int(passed), attempts, model, time.time(),
+                    duration_seconds, prompt_tokens, completion_tokens, cost_usd, json.dumps(stage_seconds or {}),
+                ),
+            )
+            connection.execute(
+                "INSERT INTO artifacts (run_id, input_schema, output_schema, unit_tests, final_script) VALUES (?, ?, ?, ?, ?)",
+                (cursor.lastrowid, *(artifacts.get(column) for column in ARTIFACT_COLUMNS)),
+            )
+        return cursor.lastrowid
+
+    def find_passing(self, specification):
+        # the newest passing run of an equivalent specification, with its artifacts
+        row = self._connection().execute(
+            f"SELECT {', '.join('runs.' + column for column in RUN_COLUMNS)}, {', '.join(ARTIFACT_COLUMNS)} "
+            "FROM runs JOIN artifacts ON artifacts.run_id = runs.id "
+            "WHERE runs.spec_hash = ? AND runs.passed = 1 ORDER BY runs.created_at DESC LIMIT 1",
+            (spec_hash(specification),),
+        ).fetchone()
+        if row is None:
+            return None
+        record = _run_record(row[:len(RUN_COLUMNS)])
+        record.update(zip(ARTIFACT_COLUMNS, row[len(RUN_COLUMNS):]))
+        return record
+
+    def passing_specifications(self):
+        # newest first, so the first run seen for a spec hash is its latest passing one; the
+        # scripts stay in the artifacts table until final_scripts asks for a few of them
+        cursor = self._connection().execute(
+            "SELECT id, spec_hash, specification, output_folder FROM runs WHERE passed = 1 ORDER BY created_at DESC"
+        )
+        for run_id, run_hash, specification, output_folder in cursor:
+            yield {"run_id": run_id, "spec_hash": run_hash, "specification": specification, "output_folder": output_folder}
+
+    def final_scripts(self, run_ids):
+        run_ids = list(run_ids)
+        if not run_ids:
+            return {}
+        cursor = self._connection().execute(
+            f"SELECT run_id, final_script FROM artifacts WHERE run_id IN ({', '.join('?' * len(run_ids))})", run_ids
+        )
+        return dict(cursor.fetchall())
+
+    def list_runs(self, limit=LIST_LIMIT, passed=None, hash_prefix=None):
+        conditions, parameters = [], []
+        if passed is not None:
+            conditions.append("passed = ?")
+            parameters.append(int(passed))
+        if hash_prefix:
+            # a prefix range instead of LIKE so the spec_hash index is used
+            conditions.append("spec_hash >= ? AND spec_hash < ?")
+            parameters += [hash_prefix, hash_prefix + "g"]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._connection().execute(
+            f"SELECT {', '.join(RUN_COLUMNS)} FROM runs {where} ORDER BY created_at DESC LIMIT ?",
+            (*parameters, limit),
+        ).fetchall()
+        return [_run_record(row) for row in rows]
+
+    def stats(self):
+        runs, passed, specs = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(passed), 0), COUNT(DISTINCT spec_hash) FROM runs"
+        ).fetchone()
+        return {"runs": runs, "passed": passed, "specifications": specs}
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List and look up generated scripts in the artifact store.")
+    parser.add_argument("--store", default=DEFAULT_STORE_PATH, help="Path of the artifact database.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    list_parser = subparsers.add_parser("list", help="List the most recent runs.")
+    list_parser.add_argument("--limit", type=int, default=LIST_LIMIT, help="Number of runs to show.")
+    list_parser.add_argument("--passed", action="store_true", help="Only show runs whose script passed.")
+    list_parser.add_argument("--hash", help="Only show runs whose spec hash starts with this prefix.")
+    find_parser = subparsers.add_parser("find", help="Print the passing script for a specification, if there is one.")
+    find_parser.add_argument("specification", help="Specification text, or @path to read it from a file.")
+    subparsers.add_parser("stats", help="Count runs and distinct specifications.")
+    args = parser.parse_args()
+
+    store = ArtifactStore(args.store)
+    if args.command == "list":
+        for run in store.list_runs(args.limit, passed=True if args.passed else None, hash_prefix=args.hash):
+            status = "passed" if run["passed"] else "failed"
+            created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run["created_at"]))
+            print(f"{run['spec_hash'][:12]}  {created}  {status:<6}  {run['attempts']} attempts  {run['output_folder']}")
+    elif args.command == "find":
+        specification = args.specification
+        if specification.startswith("@"):
+            with open(specification[1:], "r") as file:
+                specification = file.read().strip()
+        run = store.find_passing(specification)
+        if run is None:
+            parser.exit(1, "No passing script for this specification.\n")
+        print(run["final_script"])
+    else:
+        print(json.dumps(store.stats()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import argparse
+import ast
+import importlib.util
+import inspect
+import json
+import math
+import os
+import sys
+import time
+
+BATCH_SUFFIX = "_batch"
+DEFAULT_RECORDS = 1000
+SCRIPT_FILE = "final_script.py"
+INPUT_SCHEMA_FILE = "input_schema.json"
+# deeper nesting than this in a generated schema is filled with None
+MAX_SAMPLE_DEPTH = 8
+
+
+def sample_value(schema, index, depth=0):
+    # A deterministic value that satisfies the common parts of a JSON schema; index varies it
+    # from record to record so a vectorized implementation cannot get away with a constant.
+    if not isinstance(schema, dict) or depth > MAX_SAMPLE_DEPTH:
+        return None
+    if "const" in schema:
+        return schema["const"]
+    for key in ("enum", "examples"):
+        if schema.get(key):
+            return schema[key][index % len(schema[key])]
+    for key in ("oneOf", "anyOf", "allOf"):
+        if schema.get(key):
+            return sample_value(schema[key][0], index, depth + 1)
+    schema_type = schema.get("type", "object" if "properties" in schema else None)
+    if isinstance(schema_type, list):
+        schema_type = next((item for item in schema_type if item != "null"), "null")
+    if schema_type == "object":
+        return {name: sample_value(value, index, depth + 1) for name, value in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        length = max(schema.get("minItems", 0), 1 + index % 3)
+        if "maxItems" in schema:
+            length = min(length, schema["maxItems"])
+        return [sample_value(schema.get("items", {}), index + offset, depth + 1) for offset in range(length)]
+    if schema_type in ("integer", "number"):
+        low = schema.get("minimum", 0)
+        if isinstance(schema.get("exclusiveMinimum"), (int, float)) and not isinstance(schema["exclusiveMinimum"], bool):
+            low = schema["exclusiveMinimum"] + 1
+        value = low + index % 100
+        if schema_type == "number":
+            value += 0.25
+        if "maximum" in schema:
+            value = min(value, schema["maximum"])
+        return int(value) if schema_type == "integer" else value
+    if schema_type == "boolean":
+        return index % 2 == 0
+    if schema_type == "string":
+        text = {
+            "date-time": f"2024-01-{1 + index % 28:02d}T12:00:00Z",
+            "date": f"2024-01-{1 + index % 28:02d}",
+            "email": f"user{index}@example.com",
+            "uri": f"https://example.com/{index}",
+        }.get(schema.get("format"), f"value {index}")
+        text = text.ljust(schema.get("minLength", 0), "x")
+        return text[:schema["maxLength"]] if "maxLength" in schema else text
+    return None
+
+
+def sample_records(schema, count):
+    return [sample_value(schema, index) for index in range(count)]
+
+
+def batch_pairs(module):
+    # (scalar, batch) functions defined by the script, matched by the _batch suffix
+    functions = {
+        name: value for name, value in vars(module).items()
+        if inspect.isfunction(value) and value.__module__ == module.__name__
+    }
+    return [
+        (functions[name[:-len(BATCH_SUFFIX)]], batch)
+        for name, batch in functions.items()
+        if name.endswith(BATCH_SUFFIX) and name[:-len(BATCH_SUFFIX)] in functions
+    ]
+
+
+def defines_batch_pair(source):
+    # the static version of batch_pairs, to skip starting a benchmark process for nothing
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return False
+    names = {node.name for node in tree.body if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))}
+    return any(name.endswith(BATCH_SUFFIX) and name[:-len(BATCH_SUFFIX)] in names for name in names)
+
+
+def _plain(value):
+    # numpy scalars and arrays compare like the Python values they hold
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    return value
+
+
+def outputs_agree(first, second):
+    first, second = _plain(first), _plain(second)
+    if isinstance(first, float) or isinstance(second, float):
+        return isinstance(first, (int, float)) and isinstance(second, (int, float)) and math.isclose(first, second, rel_tol=1e-9, abs_tol=1e-12)
+    if isinstance(first, dict) and isinstance(second, dict):
+        return first.keys() == second.keys() and all(outputs_agree(first[key], second[key]) for key in first)
+    if isinstance(first, list) and isinstance(second, list):
+        return len(first) == len(second) and all(outputs_agree(a, b) for a, b in zip(first, second))
+    return first == second
+
+
+def compare(scalar, batch, records):
+    # Times the scalar function over every record against one call of the batch form and
+    # checks they return the same outputs.
+    result = {"function": scalar.__name__, "records": len(records)}
+    try:
+        scalar(records[0])
+    except Exception as e:
+        result["skipped"] = f"{scalar.__name__} raised {type(e).__name__} on a sample record: {e}"
+        return result
+    try:
+        started = time.perf_counter()
+        scalar_outputs = [scalar(record) for record in records]
+        result["scalar_seconds"] = round(time.perf_counter() - started, 6)
+        started = time.perf_counter()
+        batch_outputs = list(batch(records))
+        result["batch_seconds"] = round(time.perf_counter() - started, 6)
+    except Exception as e:
+        result["skipped"] = f"{type(e).__name__} on the sample records: {e}"
+        return result
+    result["agree"] = outputs_agree(scalar_outputs, batch_outputs)
+    result["speedup"] = round(result["scalar_seconds"] / result["batch_seconds"], 2) if result["batch_seconds"] else None
+    return result
+
+
+def benchmark_folder(folder, count=DEFAULT_RECORDS):
+    # Benchmarks the final script of a run folder on records sampled from its input schema.
+    # Imports the script, so run it in a process of its own (the generator does).
+    with open(os.path.join(folder, INPUT_SCHEMA_FILE), "r") as file:
+        schema = json.load(file)
+    sys.path.insert(0, os.path.abspath(folder))
+    spec = importlib.util.spec_from_file_location("final_script", os.path.join(folder, SCRIPT_FILE))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    pairs = batch_pairs(module)
+    if not pairs:
+        return {"skipped": f"{SCRIPT_FILE} defines no function with a {BATCH_SUFFIX} form"}
+    records = sample_records(schema, count)
+    return {"results": [compare(scalar, batch, records) for scalar, batch in pairs]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the scalar and _batch functions of a generated script against each other.")
+    parser.add_argument("folder", help="Run folder with final_script.py and input_schema.json.")
+    parser.add_argument("--records", type=int, default=DEFAULT_RECORDS, help="Number of records sampled from the input schema.")
+    args = parser.parse_args()
+    print(json.dumps(benchmark_folder(args.folder, args.records)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import script_generator
+from llm_replay import ReplayBackend, load_recording
+
+DEFAULT_CONCURRENCY_LEVELS = [1, 10, 100, 1000]
+DEFAULT_RECORDING = os.path.join(script_generator.GENERATED_SCRIPTS_FOLDER, "decdae84")
+BENCHMARK_RESULTS_FILE = "benchmark_results.json"
+# high enough that the rate limiter never holds a replayed request back
+UNLIMITED_RATE_LIMITS = {"requests_per_minute": 10 ** 9, "tokens_per_minute": 10 ** 12}
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(max_rss / 1024 / (1024 if os.uname().sysname == "Darwin" else 1), 1)
+
+
+def stage_overheads(reports):
+    # time a stage spends outside LLM calls: prompt building, parsing, file I/O, test runs
+    overheads = {}
+    for report in reports:
+        for name, stage in report["stages"].items():
+            if stage["runs"]:
+                overheads.setdefault(name, []).append(stage["wall_seconds"] - stage["llm_seconds"])
+    return {name: round(sum(values) / len(values), 6) for name, values in overheads.items()}
+
+
+def run_jobs(jobs, level_folder, concurrency, use_async, max_attempts):
+    if use_async:
+        async def run_all():
+            semaphore = asyncio.Semaphore(concurrency)
+            try:
+                return await asyncio.gather(*(
+                    script_generator.async_run_batch_job(job, level_folder, semaphore, max_attempts) for job in jobs
+                ))
+            finally:
+                await script_generator.close_async_client()
+        return asyncio.run(run_all())
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(lambda job: script_generator.run_batch_job(job, level_folder, max_attempts), jobs))
+
+
+def run_level(backend, requirements, concurrency, jobs, folder, use_async=False, max_attempts=script_generator.DEFAULT_MAX_ATTEMPTS):
+    level_folder = os.path.join(folder, f"concurrency-{concurrency}")
+    script_generator.create_directory(level_folder)
+    batch = [{"job_id": f"job-{index:05d}", "requirements": requirements} for index in range(jobs)]
+    calls_before = backend.metrics()["calls"]
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    started = time.perf_counter()
+    summaries = run_jobs(batch, level_folder, concurrency, use_async, max_attempts)
+    elapsed = time.perf_counter() - started
+
+    reports = []
+    for summary in summaries:
+        if "run_report" in summary:
+            with open(summary["run_report"], "r") as file:
+                reports.append(json.load(file))
+    aggregated = script_generator.aggregate_run_reports(reports)
+    result = {
+        "concurrency": concurrency,
+        "jobs": jobs,
+        "passed": sum(1 for summary in summaries if summary["status"] == "passed"),
+        "errors": sum(1 for summary in summaries if summary["status"] == "error"),
+        "seconds": round(elapsed, 3),
+        "jobs_per_second": round(jobs / elapsed, 3),
+        "job_p50_seconds": aggregated["job_p50_seconds"],
+        "job_p95_seconds": aggregated["job_p95_seconds"],
+        "job_p99_seconds": aggregated["job_p99_seconds"],
+        "llm_calls": backend.metrics()["calls"] - calls_before,
+        "retries": aggregated["totals"].get("retries", 0),
+        "stage_overhead_seconds": stage_overheads(reports),
+        "stages": aggregated["stages"],
+        "max_rss_mb": max_rss_mb(),
+    }
+    if tracemalloc.is_tracing():
+        result["python_heap_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+    return result
+
+
+def print_level(result):
+    print(
+        f"concurrency {result['concurrency']:>5}: {result['passed']}/{result['jobs']} passed in {result['seconds']}s, "
+        f"{result['jobs_per_second']} jobs/s, job p50 {result['job_p50_seconds']}s p95 {result['job_p95_seconds']}s, "
+        f"{result['retries']} retries, max RSS {result['max_rss_mb']} MB"
+    )
+    for name, overhead in result["stage_overhead_seconds"].items():
+        print(f"    {name:<18} mean overhead {overhead * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark workflow() offline by replaying recorded LLM responses at increasing concurrency."
+    )
+    parser.add_argument(
+        "--recording",
+        default=DEFAULT_RECORDING,
+        help="Run folder or function_generation.log whose LLM responses are replayed.",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=DEFAULT_CONCURRENCY_LEVELS,
+        help="Concurrent job counts to measure, one level after another.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="Jobs per level (default: the level's concurrency).",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        help="Fixed seconds per LLM call instead of the recorded latency.",
+    )
+    parser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=0.0,
+        help="Multiplier for the recorded latencies (default 0: measure pipeline overhead only).",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.0,
+        help="Random +/- fraction applied to every latency.",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of LLM calls that fail with a rate limit, server or connection error.",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=float,
+        default=0.0,
+        help="Retry-After seconds sent with injected rate limit errors.",
+    )
+    parser.add_argument(
+        "--backoff-base",
+        type=float,
+        default=script_generator.LLM_BACKOFF_BASE_SECONDS,
+        help="Base delay of the retry backoff.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed for jitter and error injection.",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Run the jobs of a level on one event loop instead of threads.",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=script_generator.DEFAULT_MAX_ATTEMPTS,
+        help="Generate-and-test attempts per job.",
+    )
+    script_generator.add_test_runner_arguments(parser, default="pool")
+    parser.add_argument(
+        "--rate-limited",
+        action="store_true",
+        help="Keep the real per-model rate limits instead of lifting them.",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Also report the Python heap peak per level (slows the run down).",
+    )
+    args = parser.parse_args()
+    script_generator.check_test_runner_arguments(parser, args)
+
+    recording = load_recording(args.recording)
+    backend = ReplayBackend(
+        recording,
+        latency=args.latency,
+        latency_scale=args.latency_scale,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    script_generator.set_llm_backend(backend)
+    # every job has the same specification, so the cache and the artifact store would answer all but the first
+    script_generator.response_cache.mode = "bypass"
+    script_generator.artifact_store.mode = "bypass"
+    script_generator.request_scheduler.base_delay = args.backoff_base
+    if not args.rate_limited:
+        script_generator.request_scheduler.limit_overrides.update(UNLIMITED_RATE_LIMITS)
+    script_generator.set_test_runner(script_generator.test_runner_from_arguments(args))
+    if args.trace_memory:
+        tracemalloc.start()
+
+    folder = script_generator.new_run_folder()
+    script_generator.configure_logging(folder)
+    results = []
+    try:
+        # one unrecorded job first, so worker start-up and first imports are not billed to a level
+        run_level(backend, recording.requirements, 1, 1, os.path.join(folder, "warmup"), args.use_async, args.max_attempts)
+        for concurrency in args.concurrency:
+            result = run_level(backend, recording.requirements, concurrency, args.jobs or concurrency, folder, args.use_async, args.max_attempts)
+            results.append(result)
+            print_level(result)
+    finally:
+        script_generator.set_test_runner(None)
+
+    results_path = os.path.join(folder, BENCHMARK_RESULTS_FILE)
+    with open(results_path, "w") as file:
+        json.dump({"recording": recording.source, "backend": backend.metrics(), "levels": results}, file, indent=4)
+    print(f"Benchmark results written to {results_path}")
+
+
+if __name__ == "__main__":
+    main()
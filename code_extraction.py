@@ -0,0 +1,92 @@
+import ast
+import json
+import re
+
+FENCED_CODE_PATTERN = re.compile(r"```(?:python|py)?[ \t]*\n(.*?)```", re.DOTALL)
+
+
+class CodeExtractionError(ValueError):
+    # a ValueError, so callers that treat an unparseable response as a failed attempt keep doing so
+    pass
+
+
+def code_response_format(key):
+    # structured output: the model must answer with a JSON object holding the code as one plain
+    # string, so quotes, backslashes and newlines are escaped by JSON and nothing else
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": f"{key}_response",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {key: {"type": "string"}},
+                "required": [key],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def fenced_code(text):
+    # the longest block, in case the model quotes a snippet before the full script
+    blocks = FENCED_CODE_PATTERN.findall(text)
+    return max(blocks, key=len) if blocks else None
+
+
+def unquoted_code(code):
+    # responses to the older repr()-style prompts often wrap the code in an extra pair of quotes
+    stripped = code.strip()
+    if len(stripped) < 2 or stripped[0] != stripped[-1] or stripped[0] not in "'\"":
+        return None
+    try:
+        value = ast.literal_eval(stripped)
+    except (ValueError, SyntaxError):
+        return stripped[1:-1]
+    return value if isinstance(value, str) else None
+
+
+def validate_python(code):
+    if not code.strip():
+        raise CodeExtractionError("The code is empty")
+    try:
+        ast.parse(code)
+    except SyntaxError as e:
+        line = (e.text or "").strip()
+        raise CodeExtractionError(f"The code does not parse: {e.msg} on line {e.lineno}: {line}") from e
+    except ValueError as e:
+        raise CodeExtractionError(f"The code does not parse: {e}") from e
+    return code
+
+
+def extract_code(response, key):
+    # Returns the Python source in a model response: the key property of a JSON object or,
+    # when the response is not JSON, its fenced code block. Whatever is found must parse,
+    # so a broken generation is rejected here rather than after a test run.
+    try:
+        data = json.loads(response)
+    except json.JSONDecodeError:
+        data = None
+    if isinstance(data, dict):
+        if not isinstance(data.get(key), str):
+            raise CodeExtractionError(f"The JSON response has no string {key!r} property")
+        texts = [data[key]]
+    else:
+        texts = []
+    fenced = fenced_code(texts[0] if texts else response)
+    if fenced is not None:
+        texts.append(fenced)
+    if not texts:
+        raise CodeExtractionError("The response is neither a JSON object nor a fenced code block")
+    unquoted = unquoted_code(texts[0])
+    if unquoted is not None:
+        # a quoted script parses as a module holding one string, so the unquoted form goes first
+        texts.insert(0, unquoted)
+
+    first_error = None
+    for text in texts:
+        try:
+            return validate_python(text)
+        except CodeExtractionError as e:
+            first_error = first_error or e
+    raise first_error
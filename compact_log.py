@@ -0,0 +1,197 @@
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import threading
+
+TEXT_LOG_FILE = "function_generation.log"
+COMPACT_LOG_FILE = "function_generation.jsonl"
+PAYLOAD_FOLDER = "payloads"
+TEXT_LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+DEFAULT_BACKUP_COUNT = 3
+# payloads shorter than this are kept inline, a hash and a file would cost more than they save
+INLINE_PAYLOAD_CHARS = 200
+
+
+def payload_extra(label, payload):
+    # extra= for a log record whose message is "label<separator>payload"
+    return {"payload_label": label, "payload": payload}
+
+
+def payload_digest(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class PayloadStore:
+    # Prompt and response bodies, one file per distinct content hash, so text that repeats
+    # across attempts or jobs is written once. A payload that extends an earlier one is kept
+    # as a link file naming that base and the added suffix; get follows the links back to a
+    # payload stored in full.
+    def __init__(self, folder):
+        self.folder = folder
+        self.written = 0
+        self.deduplicated = 0
+        self._lock = threading.Lock()
+
+    def path(self, digest):
+        return os.path.join(self.folder, digest[:2], f"{digest}.txt")
+
+    def delta_path(self, digest):
+        return os.path.join(self.folder, digest[:2], f"{digest}.delta")
+
+    def _known(self, digest):
+        if os.path.exists(self.path(digest)) or os.path.exists(self.delta_path(digest)):
+            with self._lock:
+                self.deduplicated += 1
+            return True
+        return False
+
+    def _write(self, path, text):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "w") as file:
+            file.write(text)
+        os.replace(temporary_path, path)
+        with self._lock:
+            self.written += 1
+
+    def put(self, text, digest=None):
+        digest = digest or payload_digest(text)
+        if not self._known(digest):
+            self._write(self.path(digest), text)
+        return digest
+
+    def put_delta(self, digest, base, suffix):
+        # digest's text is base's text followed by suffix; returns the suffix's digest
+        suffix_digest = self.put(suffix)
+        if not self._known(digest):
+            self._write(self.delta_path(digest), f"{base} {suffix_digest}")
+        return suffix_digest
+
+    def _read(self, path):
+        try:
+            with open(path, "r") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def get(self, digest):
+        suffixes = []
+        text = self._read(self.path(digest))
+        while text is None:
+            link = self._read(self.delta_path(digest))
+            if link is None:
+                return None
+            digest, suffix_digest = link.split()
+            suffix = self._read(self.path(suffix_digest))
+            if suffix is None:
+                return None
+            suffixes.append(suffix)
+            text = self._read(self.path(digest))
+        return text + "".join(reversed(suffixes))
+
+
+def _sampled(digest, sample_rate):
+    # decided by the hash, so the same payload is either always or never kept
+    return sample_rate >= 1.0 or int(digest[:8], 16) < sample_rate * 0x100000000
+
+
+class CompactFormatter(logging.Formatter):
+    # One JSON object per line. A record logged with payload_extra keeps only its label and a
+    # reference inline: the hash and length of the payload, and where the text can be found.
+    # Payloads of warnings and errors are always stored, the others for sample_rate of the
+    # distinct payloads. A payload that extends the previous one with the same label (the
+    # requirements transcript grows by one turn at a time) is stored as the added suffix.
+    def __init__(self, store, log_folder, sample_rate=1.0):
+        super().__init__()
+        self.store = store
+        self.store_path = os.path.relpath(store.folder, log_folder)
+        self.sample_rate = sample_rate
+        self._previous = {}
+        self._lock = threading.Lock()
+
+    def _reference(self, record):
+        payload = str(record.payload)
+        if len(payload) <= INLINE_PAYLOAD_CHARS:
+            return {"text": payload}
+        digest = payload_digest(payload)
+        reference = {"sha256": digest, "chars": len(payload), "store": self.store_path}
+        if record.levelno < logging.WARNING and not _sampled(digest, self.sample_rate):
+            reference["stored"] = False
+            return reference
+        with self._lock:
+            previous = self._previous.get(record.payload_label)
+            self._previous[record.payload_label] = (digest, payload)
+        if previous is not None and previous[0] != digest and payload.startswith(previous[1]):
+            reference["base"] = previous[0]
+            reference["suffix"] = self.store.put_delta(digest, previous[0], payload[len(previous[1]):])
+        else:
+            self.store.put(payload, digest)
+        return reference
+
+    def format(self, record):
+        event = {"time": round(record.created, 3), "level": record.levelname, "logger": record.name}
+        if hasattr(record, "payload_label"):
+            event["message"] = record.payload_label
+            event["payload"] = self._reference(record)
+        else:
+            event["message"] = record.getMessage()
+        if record.exc_info:
+            event["exception"] = self.formatException(record.exc_info)
+        return json.dumps(event, ensure_ascii=False)
+
+
+def resolve_payload(reference, log_folder, store=None):
+    # the full text of a payload reference, or None if it was sampled out
+    if "text" in reference:
+        return reference["text"]
+    if reference.get("stored", True) is False:
+        return None
+    store = store or PayloadStore(os.path.join(log_folder, reference["store"]))
+    text = store.get(reference["sha256"])
+    if text is None and "base" in reference:
+        # logs written before deltas had link files: only a base stored in full resolves
+        base, suffix = store.get(reference["base"]), store.get(reference["suffix"])
+        text = None if base is None or suffix is None else base + suffix
+    return text
+
+
+def read_compact_log(path):
+    # yields (time, level, message, payload text or None) for every event of a compact log
+    log_folder = os.path.dirname(path)
+    with open(path, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            payload = resolve_payload(event["payload"], log_folder) if "payload" in event else None
+            yield event["time"], event["level"], event["message"], payload
+
+
+class LogSettings:
+    # How run and job logs are written. "text" is the classic function_generation.log with
+    # every prompt and response inline; "compact" is function_generation.jsonl with payloads
+    # in a content-addressed store next to it. Both rotate once max_bytes is set.
+    def __init__(self):
+        self.mode = "text"
+        self.max_bytes = 0
+        self.backup_count = DEFAULT_BACKUP_COUNT
+        self.sample_rate = 1.0
+        self.payload_store = None
+
+    def log_file(self, folder):
+        return os.path.join(folder, COMPACT_LOG_FILE if self.mode == "compact" else TEXT_LOG_FILE)
+
+    def handler(self, folder):
+        handler = logging.handlers.RotatingFileHandler(
+            self.log_file(folder), maxBytes=self.max_bytes, backupCount=self.backup_count
+        )
+        if self.mode == "compact":
+            # payload_store is shared by every log of a run (see configure_logging), so a
+            # prompt repeated across batch jobs is stored once
+            store = self.payload_store or PayloadStore(os.path.join(folder, PAYLOAD_FOLDER))
+            handler.setFormatter(CompactFormatter(store, folder, self.sample_rate))
+        else:
+            handler.setFormatter(logging.Formatter(TEXT_LOG_FORMAT))
+        return handler
@@ -0,0 +1,227 @@
+import ast
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import httpx
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+from compact_log import COMPACT_LOG_FILE, TEXT_LOG_FILE, read_compact_log
+
+LOG_ENTRY_PATTERN = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) - [A-Z]+ - ", re.MULTILINE)
+STREAM_CHUNK_CHARS = 16
+REPAIR_MARKER = "Your previous attempt was:"
+# what each pipeline prompt starts with, so a request can be answered without knowing the caller
+PROMPT_KINDS = [
+    ("Create a JSON schema for the input", "input_schema"),
+    ("Create a JSON schema for the output", "output_schema"),
+    ("Create a series of unit tests", "unit_tests"),
+    ("Write the python script for this specification", "script"),
+    ("Summarise this part of a requirements conversation", "summary"),
+    ("Rewrite the following requirements conversation", "distill"),
+    ("Given the current specifications", "clarification"),
+]
+INJECTED_ERRORS = ["rate_limit", "server_error", "connection_error"]
+REPLAY_URL = "https://replay.invalid/v1/chat/completions"
+
+
+class Recording:
+    # The LLM responses of one past run, grouped by prompt kind, each with the latency
+    # the real API took to produce it.
+    def __init__(self, source, requirements=""):
+        self.source = source
+        self.requirements = requirements
+        self.responses = {}
+
+    def add(self, kind, text, latency):
+        self.responses.setdefault(kind, []).append((text, latency))
+
+    def response(self, kind, repair=False):
+        if kind in ("summary", "distill") and kind not in self.responses:
+            # these calls are not logged by older runs; the requirements stand in for them
+            return self.requirements, 0.0
+        if kind not in self.responses:
+            raise LookupError(f"{self.source} has no recorded {kind} response")
+        # repair prompts get the last recorded attempt, which is the passing one if the run passed
+        return self.responses[kind][-1 if repair else 0]
+
+
+def _log_time(stamp):
+    return datetime.strptime(stamp, "%Y-%m-%d %H:%M:%S,%f").timestamp()
+
+
+def _log_entries(text):
+    matches = list(LOG_ENTRY_PATTERN.finditer(text))
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+        yield _log_time(match.group(1)), text[match.end():end].rstrip("\n")
+
+
+def _compact_log_entries(path):
+    # the same messages as the text log; payloads that were sampled out leave only their label
+    for logged_at, _, message, payload in read_compact_log(path):
+        yield logged_at, message if payload is None else f"{message}: {payload}"
+
+
+def _raw_response_kind(raw):
+    try:
+        response = json.loads(raw)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(response, dict) and "unit_tests" in response:
+        return "unit_tests"
+    if isinstance(response, dict) and "python_code" in response:
+        return "script"
+    return None
+
+
+def load_recording(path):
+    # Rebuilds the responses of a run from its function_generation.log (or the .jsonl of a
+    # compact log). Latency is the gap between the previous log entry and the logged HTTP
+    # request that returned the response.
+    if os.path.isdir(path):
+        text_path = os.path.join(path, TEXT_LOG_FILE)
+        path = text_path if os.path.exists(text_path) else os.path.join(path, COMPACT_LOG_FILE)
+    if path.endswith(".jsonl"):
+        entries = _compact_log_entries(path)
+    else:
+        with open(path, "r") as file:
+            entries = _log_entries(file.read())
+    recording = Recording(path)
+    previous_time = None
+    latency = None
+    for logged_at, message in entries:
+        if message.startswith("HTTP Request:"):
+            latency = logged_at - previous_time if previous_time is not None else 0.0
+        elif message.startswith("Requirements provided as a direct string"):
+            pass
+        elif latency is not None and message.startswith("Gathering requirements:"):
+            turns = message.split("\nLLM: ")
+            recording.add("clarification", turns[-1].strip(), latency)
+            if not recording.requirements:
+                recording.requirements = turns[0].split("User: ", 1)[-1].strip()
+            latency = None
+        elif latency is not None and message.startswith("Distilled specification: "):
+            recording.add("distill", message[len("Distilled specification: "):], latency)
+            latency = None
+        elif message.startswith("Generated input schema: ") or message.startswith("Generated output schema: "):
+            kind = "input_schema" if message.startswith("Generated input") else "output_schema"
+            schema = ast.literal_eval(message.split(": ", 1)[1])
+            recording.add(kind, json.dumps(schema), latency or 0.0)
+            latency = None
+        elif message.startswith("Raw LLM response: "):
+            raw = message[len("Raw LLM response: "):]
+            kind = _raw_response_kind(raw)
+            if kind is not None:
+                recording.add(kind, raw, latency or 0.0)
+            latency = None
+        previous_time = logged_at
+    return recording
+
+
+def prompt_kind(completion_args):
+    prompt = completion_args["messages"][-1]["content"].strip()
+    for prefix, kind in PROMPT_KINDS:
+        if prompt.startswith(prefix):
+            return kind, REPAIR_MARKER in prompt
+    return "clarification", False
+
+
+def _usage(completion_args, contents):
+    prompt_chars = sum(len(message["content"]) for message in completion_args["messages"])
+    completion_tokens = sum(len(content) for content in contents) // 4
+    return SimpleNamespace(
+        prompt_tokens=prompt_chars // 4,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_chars // 4 + completion_tokens,
+    )
+
+
+def _completion(completion_args, text):
+    contents = [text] * completion_args.get("n", 1)
+    return SimpleNamespace(
+        choices=[SimpleNamespace(index=index, message=SimpleNamespace(role="assistant", content=content)) for index, content in enumerate(contents)],
+        usage=_usage(completion_args, contents),
+    )
+
+
+def _chunks(text):
+    for start in range(0, len(text), STREAM_CHUNK_CHARS):
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text[start:start + STREAM_CHUNK_CHARS]))])
+
+
+async def _async_chunks(text):
+    for chunk in _chunks(text):
+        yield chunk
+
+
+class ReplayBackend:
+    # An LLM backend (see script_generator.set_llm_backend) that answers from a Recording
+    # instead of the API. Latency is either fixed or the recorded one scaled, with optional
+    # jitter, and error_rate of the calls fail with a rate limit, server or connection error.
+    def __init__(self, recording, latency=None, latency_scale=1.0, jitter=0.0, error_rate=0.0, retry_after=0.0, seed=None):
+        self.recording = recording
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.errors = {kind: 0 for kind in INJECTED_ERRORS}
+        self._lock = threading.Lock()
+
+    def _plan(self, completion_args):
+        # decides the response, the delay and any injected error up front, under the lock,
+        # so a seeded backend makes the same decisions in the same call order
+        kind, repair = prompt_kind(completion_args)
+        text, recorded_latency = self.recording.response(kind, repair)
+        with self._lock:
+            self.calls += 1
+            delay = self.latency if self.latency is not None else recorded_latency * self.latency_scale
+            if self.jitter:
+                delay *= self.random.uniform(1 - self.jitter, 1 + self.jitter)
+            error = None
+            if self.error_rate and self.random.random() < self.error_rate:
+                error = self.random.choice(INJECTED_ERRORS)
+                self.errors[error] += 1
+        return text, max(delay, 0.0), error
+
+    def _error(self, error):
+        request = httpx.Request("POST", REPLAY_URL)
+        if error == "connection_error":
+            return APIConnectionError(message="Injected connection error", request=request)
+        if error == "rate_limit":
+            headers = {"retry-after-ms": str(int(self.retry_after * 1000))} if self.retry_after else {}
+            response = httpx.Response(429, headers=headers, request=request)
+            return RateLimitError("Injected rate limit", response=response, body=None)
+        response = httpx.Response(500, request=request)
+        return InternalServerError("Injected server error", response=response, body=None)
+
+    def create(self, stream=False, **completion_args):
+        text, delay, error = self._plan(completion_args)
+        time.sleep(delay)
+        if error is not None:
+            raise self._error(error)
+        if stream:
+            return _chunks(text)
+        return _completion(completion_args, text)
+
+    async def async_create(self, stream=False, **completion_args):
+        text, delay, error = self._plan(completion_args)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise self._error(error)
+        if stream:
+            return _async_chunks(text)
+        return _completion(completion_args, text)
+
+    def metrics(self):
+        with self._lock:
+            return {"calls": self.calls, "injected_errors": dict(self.errors)}
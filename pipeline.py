@@ -0,0 +1,259 @@
+import argparse
+import ast
+import collections
+import importlib.util
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import count
+
+from batch_benchmark import BATCH_SUFFIX, INPUT_SCHEMA_FILE, SCRIPT_FILE
+from sandbox import default_context
+from script_runtime import BATCH_CHUNK_RECORDS, STDIO, chunks, process_batches, process_records, read_records, write_records
+
+OUTPUT_SCHEMA_FILE = "output_schema.json"
+# chunks in flight per worker of a parallel stage, so a long input is not read ahead in full
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+
+logger = logging.getLogger(__name__)
+_module_numbers = count()
+
+
+class PipelineError(ValueError):
+    pass
+
+
+def _is_main_guard(test):
+    return (
+        isinstance(test, ast.Compare) and isinstance(test.left, ast.Name) and test.left.id == "__name__"
+        and any(isinstance(value, ast.Constant) and value.value == "__main__" for value in test.comparators)
+    )
+
+
+def entry_points(source):
+    # (function, batch function or None) a script hands to script_runtime.run under its
+    # __main__ guard, or else its only function with a _batch form
+    tree = ast.parse(source)
+    for node in tree.body:
+        if isinstance(node, ast.If) and _is_main_guard(node.test):
+            for call in ast.walk(node):
+                if isinstance(call, ast.Call) and isinstance(call.func, ast.Name) and call.func.id == "run":
+                    names = [arg.id for arg in call.args[:2] if isinstance(arg, ast.Name)]
+                    if names:
+                        return names[0], names[1] if len(names) > 1 else None
+    functions = {node.name for node in tree.body if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))}
+    paired = [name[:-len(BATCH_SUFFIX)] for name in functions if name.endswith(BATCH_SUFFIX) and name[:-len(BATCH_SUFFIX)] in functions]
+    if len(paired) == 1:
+        return paired[0], paired[0] + BATCH_SUFFIX
+    return None, None
+
+
+class Stage:
+    # One passing script of a run folder, imported as a module: the function it processes
+    # records with, its _batch form if it has one, and its input and output schemas.
+    # "FOLDER:function" picks the function when the script does not make it clear.
+    def __init__(self, target, workers=1):
+        self.folder, _, function_name = target.partition(":")
+        self.name = os.path.basename(os.path.normpath(self.folder))
+        self.target = target
+        self.workers = workers
+        script_path = os.path.join(self.folder, SCRIPT_FILE)
+        if not os.path.exists(script_path):
+            raise PipelineError(f"{self.folder} has no {SCRIPT_FILE}")
+        with open(script_path, "r") as file:
+            source = file.read()
+        batch_name = None
+        if not function_name:
+            function_name, batch_name = entry_points(source)
+            if function_name is None:
+                raise PipelineError(f"Cannot tell which function of {script_path} processes a record, use {self.folder}:<function>")
+        self.input_schema = self._read_schema(INPUT_SCHEMA_FILE)
+        self.output_schema = self._read_schema(OUTPUT_SCHEMA_FILE)
+
+        # the script imports script_runtime and anything else next to it
+        if os.path.abspath(self.folder) not in sys.path:
+            sys.path.append(os.path.abspath(self.folder))
+        spec = importlib.util.spec_from_file_location(f"pipeline_stage_{next(_module_numbers)}", script_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        self.function = getattr(module, function_name, None)
+        if not callable(self.function):
+            raise PipelineError(f"{script_path} defines no function {function_name}")
+        batch = getattr(module, batch_name or function_name + BATCH_SUFFIX, None)
+        self.batch_function = batch if callable(batch) else None
+
+    def _read_schema(self, file_name):
+        path = os.path.join(self.folder, file_name)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as file:
+            return json.load(file)
+
+    def process(self, records, chunk_size=BATCH_CHUNK_RECORDS, errors=None):
+        if self.batch_function is not None:
+            return process_batches(self.batch_function, self.function, records, chunk_size, errors)
+        return process_records(self.function, records, errors)
+
+
+def _types(schema):
+    schema_type = schema.get("type")
+    if schema_type is None:
+        return {"object"} if "properties" in schema else None
+    types = set(schema_type) if isinstance(schema_type, list) else {schema_type}
+    # an integer is a valid number
+    return types | {"number"} if "integer" in types else types
+
+
+def schema_problems(output_schema, input_schema, path="$"):
+    # Where records matching output_schema could fail input_schema: a type that cannot be
+    # accepted, a required property that is never produced, a property the next stage
+    # forbids, an enum value it does not know. Returns (problems, warnings); warnings are
+    # required properties the upstream output only produces optionally.
+    problems, warnings = [], []
+    if not isinstance(output_schema, dict) or not isinstance(input_schema, dict):
+        return problems, warnings
+    produced, accepted = _types(output_schema), _types(input_schema)
+    if produced and accepted and not produced & accepted:
+        problems.append(f"{path} is {'/'.join(sorted(produced))} but the next stage expects {'/'.join(sorted(accepted))}")
+        return problems, warnings
+    if "enum" in output_schema and "enum" in input_schema:
+        unknown = [value for value in output_schema["enum"] if value not in input_schema["enum"]]
+        if unknown:
+            problems.append(f"{path} can be {', '.join(map(json.dumps, unknown))}, which the next stage does not accept")
+    output_properties = output_schema.get("properties", {})
+    input_properties = input_schema.get("properties", {})
+    if (accepted is None or "object" in accepted) and (output_properties or input_properties):
+        output_required = set(output_schema.get("required", []))
+        for name in input_schema.get("required", []):
+            if name not in output_properties:
+                problems.append(f"{path}.{name} is required by the next stage but not produced")
+            elif name not in output_required:
+                warnings.append(f"{path}.{name} is required by the next stage but only produced optionally")
+        if input_schema.get("additionalProperties") is False:
+            for name in output_properties.keys() - input_properties.keys():
+                problems.append(f"{path}.{name} is produced but the next stage does not allow it")
+        for name in output_properties.keys() & input_properties.keys():
+            nested_problems, nested_warnings = schema_problems(output_properties[name], input_properties[name], f"{path}.{name}")
+            problems += nested_problems
+            warnings += nested_warnings
+    if isinstance(output_schema.get("items"), dict) and isinstance(input_schema.get("items"), dict):
+        nested_problems, nested_warnings = schema_problems(output_schema["items"], input_schema["items"], f"{path}[]")
+        problems += nested_problems
+        warnings += nested_warnings
+    return problems, warnings
+
+
+_worker_stage = None
+
+
+def _start_worker(target):
+    global _worker_stage
+    _worker_stage = Stage(target)
+
+
+def _process_chunk(chunk, chunk_size, collect_errors):
+    errors = [] if collect_errors else None
+    return list(_worker_stage.process(chunk, chunk_size, errors)), errors or []
+
+
+class Pipeline:
+    # Chains the scripts of several run folders in one process. Adjacent schemas are checked
+    # once, when the pipeline is built, and records then stream from stage to stage as
+    # Python objects: no files, no JSON in between and no process per hop. A stage with
+    # workers > 1 processes chunks of records on a process pool of its own, in order.
+    def __init__(self, targets, workers=None, chunk_size=BATCH_CHUNK_RECORDS, context=None):
+        if not targets:
+            raise PipelineError("A pipeline needs at least one stage")
+        workers = workers or [1] * len(targets)
+        self.stages = [Stage(target, stage_workers) for target, stage_workers in zip(targets, workers)]
+        self.chunk_size = chunk_size
+        self.context = context
+        self.errors = []
+        self.validate()
+
+    def validate(self):
+        problems = []
+        for upstream, downstream in zip(self.stages, self.stages[1:]):
+            if upstream.output_schema is None or downstream.input_schema is None:
+                logger.warning(f"Cannot check {upstream.name} -> {downstream.name}: a schema file is missing")
+                continue
+            link_problems, link_warnings = schema_problems(upstream.output_schema, downstream.input_schema)
+            problems += [f"{upstream.name} -> {downstream.name}: {problem}" for problem in link_problems]
+            for warning in link_warnings:
+                logger.warning(f"{upstream.name} -> {downstream.name}: {warning}")
+        if problems:
+            raise PipelineError("The stages do not fit together:\n" + "\n".join(problems))
+
+    def _tagged(self, stage, errors):
+        for error in errors:
+            self.errors.append({**error, "stage": stage.name})
+
+    def _serial(self, stage, records, collect_errors):
+        errors = [] if collect_errors else None
+        yield from stage.process(records, self.chunk_size, errors)
+        self._tagged(stage, errors or [])
+
+    def _parallel(self, stage, records, collect_errors):
+        context = self.context or default_context()
+        with ProcessPoolExecutor(stage.workers, mp_context=context, initializer=_start_worker, initargs=(stage.target,)) as executor:
+            pending = collections.deque()
+            for chunk in chunks(records, self.chunk_size):
+                pending.append(executor.submit(_process_chunk, chunk, self.chunk_size, collect_errors))
+                if len(pending) >= stage.workers * CHUNKS_IN_FLIGHT_PER_WORKER:
+                    outputs, errors = pending.popleft().result()
+                    self._tagged(stage, errors)
+                    yield from outputs
+            while pending:
+                outputs, errors = pending.popleft().result()
+                self._tagged(stage, errors)
+                yield from outputs
+
+    def run(self, records, collect_errors=False):
+        # A generator of the last stage's outputs. With collect_errors, records that raise are
+        # added to self.errors, tagged with their stage, instead of stopping the pipeline.
+        for stage in self.stages:
+            if stage.workers > 1:
+                records = self._parallel(stage, records, collect_errors)
+            else:
+                records = self._serial(stage, records, collect_errors)
+        return records
+
+
+def _workers_per_stage(value, stages):
+    workers = [int(item) for item in value.split(",")] if value else [1]
+    if len(workers) == 1:
+        workers *= stages
+    if len(workers) != stages or min(workers) < 1:
+        raise PipelineError(f"--workers needs one positive number, or one per stage ({stages})")
+    return workers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chain generated scripts and stream records through them in one process.")
+    parser.add_argument("stages", nargs="+", help="Run folders with a passing final_script.py, in order. FOLDER:function picks the function.")
+    parser.add_argument("--input", default=STDIO, help="JSON lines or JSON input file, - for stdin.")
+    parser.add_argument("--output", default=STDIO, help="JSON lines output file, - for stdout.")
+    parser.add_argument("--errors", help="Write records that raise, with their stage, to this JSON lines file and carry on with the rest.")
+    parser.add_argument("--workers", help="Worker processes per stage: one number for every stage or a comma-separated list, e.g. 1,4,1.")
+    parser.add_argument("--chunk-size", type=int, default=BATCH_CHUNK_RECORDS, help="Records per batch call and per task sent to a worker.")
+    parser.add_argument("--check", action="store_true", help="Only load the stages and check that their schemas fit together.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s", stream=sys.stderr)
+
+    try:
+        pipeline = Pipeline(args.stages, _workers_per_stage(args.workers, len(args.stages)), args.chunk_size)
+    except PipelineError as e:
+        parser.exit(1, f"{e}\n")
+    if args.check:
+        logger.info(f"{len(pipeline.stages)} stages fit together")
+        return
+    written = write_records(pipeline.run(read_records(args.input), collect_errors=bool(args.errors)), args.output)
+    if args.errors:
+        write_records(pipeline.errors, args.errors)
+    logger.info(f"{written} records written, {len(pipeline.errors)} failed")
+
+
+if __name__ == "__main__":
+    main()
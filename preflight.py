@@ -0,0 +1,178 @@
+import ast
+import functools
+import importlib.util
+import os
+import sys
+
+SCRIPT_MODULE = "generated_script"
+SCRIPT_FILE = f"{SCRIPT_MODULE}.py"
+TEST_FILE = "test_script.py"
+# modules next to this file are importable here but not from a candidate's folder
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+IMPORT_ERROR_NAMES = {"ImportError", "ModuleNotFoundError", "Exception", "BaseException"}
+STANDARD_MODULES = set(sys.builtin_module_names) | set(getattr(sys, "stdlib_module_names", ()))
+BODY_FIELDS = ("body", "orelse", "finalbody", "handlers", "cases")
+
+
+def _parse(code, file_name):
+    try:
+        return ast.parse(code, filename=file_name), None
+    except SyntaxError as e:
+        line = (e.text or "").strip()
+        return None, f"{file_name} has a syntax error on line {e.lineno}: {e.msg}: {line}"
+    except ValueError as e:
+        return None, f"{file_name} cannot be parsed: {e}"
+
+
+def _module_statements(tree):
+    # every statement that runs at import time, i.e. not inside a function or class body
+    pending = list(tree.body)
+    while pending:
+        node = pending.pop()
+        yield node
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+        for field in BODY_FIELDS:
+            pending.extend(getattr(node, field, None) or [])
+
+
+def _header_nodes(node):
+    # the parts of a statement outside its nested bodies, e.g. the target of a for loop
+    for field, value in ast.iter_fields(node):
+        if field in BODY_FIELDS:
+            continue
+        for item in value if isinstance(value, list) else [value]:
+            if isinstance(item, ast.AST):
+                yield from ast.walk(item)
+
+
+def defined_names(tree):
+    # Module-level names of a script. None when they cannot be known statically
+    # (a star import or a call to globals()).
+    names = set()
+    for node in _module_statements(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == "*":
+                    return None
+                names.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        else:
+            names.update(
+                child.id for child in _header_nodes(node) if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Store)
+            )
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Global):
+            names.update(node.names)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "globals":
+            return None
+    return names
+
+
+def required_names(tests_tree, module=SCRIPT_MODULE):
+    # (name, line) pairs the tests expect the script to define: from-imports, attributes of an
+    # imported module and patch() targets such as "generated_script.requests.get"
+    required = []
+    aliases = set()
+    for node in ast.walk(tests_tree):
+        if isinstance(node, ast.ImportFrom) and node.module == module and not node.level:
+            required += [(alias.name, node.lineno) for alias in node.names if alias.name != "*"]
+        elif isinstance(node, ast.Import):
+            aliases.update(alias.asname or alias.name for alias in node.names if alias.name == module)
+    for node in ast.walk(tests_tree):
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id in aliases:
+            required.append((node.attr, node.lineno))
+        elif isinstance(node, ast.Constant) and isinstance(node.value, str) and node.value.startswith(f"{module}."):
+            required.append((node.value.split(".")[1], node.lineno))
+    return required
+
+
+def _guarded_nodes(tree):
+    # imports inside a try that handles ImportError are optional dependencies
+    guarded = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Try) and any(_handles_import_error(handler) for handler in node.handlers):
+            for statement in node.body:
+                guarded.update(id(child) for child in ast.walk(statement))
+    return guarded
+
+
+def _handles_import_error(handler):
+    if handler.type is None:
+        return True
+    types = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+    return any(isinstance(type_, ast.Name) and type_.id in IMPORT_ERROR_NAMES for type_ in types)
+
+
+@functools.lru_cache(maxsize=None)
+def _installed(module):
+    try:
+        spec = importlib.util.find_spec(module)
+    except (ImportError, ValueError):
+        return False
+    if spec is None:
+        return False
+    origin = spec.origin or next(iter(spec.submodule_search_locations or []), "")
+    return not os.path.abspath(origin).startswith(PACKAGE_DIR + os.sep)
+
+
+def module_resolves(module, folder=None):
+    if module in STANDARD_MODULES:
+        return True
+    if folder and (os.path.exists(os.path.join(folder, f"{module}.py")) or os.path.isdir(os.path.join(folder, module))):
+        return True
+    return _installed(module)
+
+
+def unresolved_imports(tree, folder=None):
+    guarded = _guarded_nodes(tree)
+    unresolved = []
+    for node in ast.walk(tree):
+        if id(node) in guarded:
+            continue
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                unresolved.append((f"{'.' * node.level}{node.module or ''}", node.lineno, "relative imports do not work in a standalone script"))
+                continue
+            modules = [node.module]
+        else:
+            continue
+        for module in modules:
+            top = module.split(".")[0]
+            if not module_resolves(top, folder):
+                unresolved.append((module, node.lineno, f"no module named {top!r} is installed"))
+    return unresolved
+
+
+def check_script(script, unit_tests, folder=None):
+    # Static checks of a candidate script against its tests, run before any test process
+    # is started. Returns a list of diagnostics; an empty list means the script may run.
+    script_tree, error = _parse(script, SCRIPT_FILE)
+    if error:
+        return [error]
+    diagnostics = []
+    for module, line, reason in unresolved_imports(script_tree, folder):
+        diagnostics.append(
+            f"{SCRIPT_FILE} line {line} imports {module}, but {reason}. "
+            f"Use only the standard library and installed packages, or define the code in {SCRIPT_FILE} itself."
+        )
+    tests_tree, error = _parse(unit_tests, TEST_FILE)
+    if error:
+        return diagnostics + [error]
+    names = defined_names(script_tree)
+    if names is not None:
+        missing = {}
+        for name, line in required_names(tests_tree):
+            if name not in names:
+                missing.setdefault(name, line)
+        for name, line in missing.items():
+            diagnostics.append(
+                f"{TEST_FILE} line {line} uses {SCRIPT_MODULE}.{name}, but {SCRIPT_FILE} does not define {name} "
+                f"at module level. Define it with exactly that name."
+            )
+    return diagnostics
@@ -0,0 +1,34 @@
+import string
+
+
+class PromptTemplate:
+    # A prompt split into a system message that is identical for every job and a user message
+    # that holds the job's data, so requests share the longest possible prefix and the
+    # provider's prompt cache can serve it. Both parts are prepared once, when the template
+    # is defined: the system text is final, and the user text is parsed into literal chunks
+    # and {field} slots, which makes rendering a single join. Field values are inserted as
+    # they are; format specs and conversions are not supported.
+    def __init__(self, name, system, user):
+        self.name = name
+        self.system = system.strip()
+        self._parts = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(user.strip()):
+            if format_spec or conversion:
+                raise ValueError(f"Prompt template {name} uses a format spec or conversion in {{{field}}}")
+            self._parts.append((literal, field))
+        self.fields = frozenset(field for _, field in self._parts if field is not None)
+
+    def render(self, **values):
+        missing = self.fields - values.keys()
+        if missing:
+            raise KeyError(f"Prompt template {self.name} is missing {', '.join(sorted(missing))}")
+        pieces = []
+        for literal, field in self._parts:
+            pieces.append(literal)
+            if field is not None:
+                pieces.append(str(values[field]))
+        return "".join(pieces)
+
+    def arguments(self, **values):
+        # keyword arguments for return_gpt_response and friends
+        return {"system_content": self.system, "prompt": self.render(**values)}
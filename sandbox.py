@@ -0,0 +1,370 @@
+import contextlib
+import importlib.util
+import io
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+import unittest
+
+try:
+    import resource
+except ImportError:  # not available on Windows, limits are then wall-clock only
+    resource = None
+
+SCRIPT_MODULE = "generated_script"
+TEST_MODULE = "test_script"
+DEFAULT_TEST_TIMEOUT = 60
+DEFAULT_CPU_SECONDS = 30
+DEFAULT_MEMORY_MB = 1024
+DEFAULT_MAX_JOBS_PER_WORKER = 100
+# how often a waiting run checks whether it was cancelled
+CANCEL_POLL_SECONDS = 0.05
+# imported once in the fork server so every worker starts with them already loaded
+PRELOAD_MODULES = ["unittest", "unittest.mock", "json", "requests"]
+
+
+class RecordingTestResult(unittest.TextTestResult):
+    # Keeps a structured record (status, duration, message) for every test next to
+    # the usual unittest text output, which is what the repair prompt is built from.
+    def __init__(self, stream, descriptions, verbosity):
+        super().__init__(stream, descriptions, verbosity)
+        self.records = []
+        self._started = 0.0
+        self._status = None
+        self._message = ""
+
+    def startTest(self, test):
+        self._started = time.perf_counter()
+        self._status = "pass"
+        self._message = ""
+        super().startTest(test)
+
+    def stopTest(self, test):
+        super().stopTest(test)
+        self.records.append({
+            "name": test.id(),
+            "status": self._status,
+            "duration": round(time.perf_counter() - self._started, 6),
+            "message": self._message,
+        })
+
+    def addFailure(self, test, err):
+        super().addFailure(test, err)
+        self._status = "fail"
+        self._message = self.failures[-1][1]
+
+    def addError(self, test, err):
+        super().addError(test, err)
+        self._status = "error"
+        self._message = self.errors[-1][1]
+
+    def addSkip(self, test, reason):
+        super().addSkip(test, reason)
+        self._status = "skip"
+        self._message = reason
+
+    def addUnexpectedSuccess(self, test):
+        super().addUnexpectedSuccess(test)
+        self._status = "fail"
+        self._message = "unexpected success"
+
+
+def _load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def _forget_job_modules(folder):
+    # modules imported from the job folder go, library imports stay warm for the next job
+    for name, module in list(sys.modules.items()):
+        module_file = getattr(module, "__file__", None) or ""
+        if name in (SCRIPT_MODULE, TEST_MODULE) or module_file.startswith(folder + os.sep):
+            del sys.modules[name]
+
+
+def run_test_job(folder):
+    # Runs test_script.py against generated_script.py from `folder` inside the current
+    # interpreter and puts the process back the way it was afterwards.
+    folder = os.path.abspath(folder)
+    previous_cwd = os.getcwd()
+    previous_path = list(sys.path)
+    stream = io.StringIO()
+    started = time.perf_counter()
+    try:
+        os.chdir(folder)
+        sys.path.insert(0, folder)
+        with contextlib.redirect_stdout(stream), contextlib.redirect_stderr(stream):
+            _load_module(SCRIPT_MODULE, os.path.join(folder, f"{SCRIPT_MODULE}.py"))
+            test_module = _load_module(TEST_MODULE, os.path.join(folder, f"{TEST_MODULE}.py"))
+            suite = unittest.defaultTestLoader.loadTestsFromModule(test_module)
+            runner = unittest.TextTestRunner(stream=stream, verbosity=2, resultclass=RecordingTestResult)
+            result = runner.run(suite)
+        passed = result.wasSuccessful()
+        tests = result.records
+    except BaseException:
+        # import errors, syntax errors and sys.exit() in the generated code all land here
+        stream.write(traceback.format_exc())
+        passed = False
+        tests = []
+    finally:
+        os.chdir(previous_cwd)
+        sys.path[:] = previous_path
+        _forget_job_modules(folder)
+    return {
+        "passed": passed,
+        "tests": tests,
+        "output": stream.getvalue(),
+        "duration": round(time.perf_counter() - started, 6),
+    }
+
+
+def _limit_memory(memory_mb):
+    if resource is None or not memory_mb:
+        return
+    limit = memory_mb * 1024 * 1024
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _limit_cpu(cpu_seconds):
+    # RLIMIT_CPU counts the whole process lifetime, so each job gets its budget on top
+    # of what the worker has already used. Exceeding it kills the worker with SIGXCPU.
+    if resource is None or not cpu_seconds:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = int(usage.ru_utime + usage.ru_stime) + 1
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    limit = used + cpu_seconds
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+
+
+def _worker_main(connection, cpu_seconds=None, memory_mb=None):
+    _limit_memory(memory_mb)
+    while True:
+        try:
+            folder = connection.recv()
+        except EOFError:
+            break
+        if folder is None:
+            break
+        _limit_cpu(cpu_seconds)
+        connection.send(run_test_job(folder))
+
+
+def _failed_job(message, started):
+    return {
+        "passed": False,
+        "tests": [],
+        "output": message,
+        "duration": round(time.perf_counter() - started, 6),
+    }
+
+
+def default_context():
+    # forkserver avoids forking a parent that may be running batch threads. Only this
+    # module and the test dependencies are preloaded, not the caller's __main__.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        # the fork server skips preload modules that are not installed
+        context.set_forkserver_preload([__name__] + PRELOAD_MODULES)
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+class TestWorker:
+    # A long-lived worker process that runs test jobs in-process, so each job
+    # skips interpreter start-up. A worker that times out or crashes is replaced,
+    # and a healthy one is recycled after max_jobs jobs to bound state leaking between jobs.
+    def __init__(self, timeout=DEFAULT_TEST_TIMEOUT, cpu_seconds=DEFAULT_CPU_SECONDS, memory_mb=DEFAULT_MEMORY_MB, max_jobs=DEFAULT_MAX_JOBS_PER_WORKER, context=None):
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.max_jobs = max_jobs
+        self.context = context or default_context()
+        self.process = None
+        self.connection = None
+        self.jobs_since_start = 0
+        self.jobs_completed = 0
+        self.crashes = 0
+        self.timeouts = 0
+        self.recycles = 0
+        self.cancellations = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        parent_connection, child_connection = self.context.Pipe()
+        self.process = self.context.Process(
+            target=_worker_main,
+            args=(child_connection, self.cpu_seconds, self.memory_mb),
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+        self.connection = parent_connection
+        self.jobs_since_start = 0
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.connection.close()
+        self.process = None
+        self.connection = None
+
+    def _wait_for_result(self, started, cancelled):
+        # True once a result can be read; False after the job was stopped for taking too long
+        # or for being cancelled through the cancelled event
+        while not self.connection.poll(CANCEL_POLL_SECONDS):
+            if cancelled is not None and cancelled.is_set():
+                self.stop()
+                self.cancellations += 1
+                return False
+            if self.timeout is not None and time.perf_counter() - started >= self.timeout:
+                self.stop()
+                self.timeouts += 1
+                return False
+        return True
+
+    def run(self, folder, cancelled=None):
+        # cancelled is an optional threading.Event: setting it kills a job that is still running,
+        # and the next job starts a fresh process
+        with self._lock:
+            if cancelled is not None and cancelled.is_set():
+                return _failed_job("Test run cancelled", time.perf_counter())
+            if self.process is None or not self.process.is_alive():
+                self.stop()
+                self.start()
+            started = time.perf_counter()
+            # a worker that dies before or while it runs the job closes its end of the pipe:
+            # EOFError on an orderly close, ConnectionResetError or BrokenPipeError otherwise
+            try:
+                self.connection.send(os.path.abspath(folder))
+            except OSError:
+                return self._crashed(started)
+            self.jobs_since_start += 1
+            self.jobs_completed += 1
+            if not self._wait_for_result(started, cancelled):
+                if cancelled is not None and cancelled.is_set():
+                    return _failed_job("Test run cancelled", started)
+                return _failed_job(f"Test run timed out after {self.timeout} seconds", started)
+            try:
+                result = self.connection.recv()
+            except (EOFError, OSError):
+                return self._crashed(started)
+            if self.max_jobs and self.jobs_since_start >= self.max_jobs:
+                self._shutdown()
+                self.start()
+                self.recycles += 1
+            return result
+
+    def _crashed(self, started):
+        self.process.join(timeout=1)
+        exitcode = self.process.exitcode
+        self.stop()
+        self.crashes += 1
+        return _failed_job(f"Test worker exited unexpectedly with code {exitcode}", started)
+
+    def _shutdown(self):
+        if self.connection is not None and self.process.is_alive():
+            try:
+                self.connection.send(None)
+                self.process.join(timeout=1)
+            except OSError:
+                # already gone; stop() cleans up
+                pass
+        self.stop()
+
+    def close(self):
+        with self._lock:
+            self._shutdown()
+
+    def metrics(self):
+        return {
+            "jobs_completed": self.jobs_completed,
+            "crashes": self.crashes,
+            "timeouts": self.timeouts,
+            "recycles": self.recycles,
+            "cancellations": self.cancellations,
+        }
+
+
+class SandboxPool:
+    # A fixed set of pre-started TestWorkers shared by every job in the process.
+    # Jobs wait for an idle worker; queue depth and utilisation are tracked for reporting.
+    def __init__(self, workers=None, timeout=DEFAULT_TEST_TIMEOUT, cpu_seconds=DEFAULT_CPU_SECONDS, memory_mb=DEFAULT_MEMORY_MB, max_jobs=DEFAULT_MAX_JOBS_PER_WORKER, context=None):
+        context = context or default_context()
+        self.workers = [
+            TestWorker(timeout=timeout, cpu_seconds=cpu_seconds, memory_mb=memory_mb, max_jobs=max_jobs, context=context)
+            for _ in range(workers or os.cpu_count() or 1)
+        ]
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.started = time.perf_counter()
+        for worker in self.workers:
+            worker.start()
+            self._idle.put(worker)
+
+    def run(self, folder, cancelled=None):
+        queued = time.perf_counter()
+        with self._lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        worker = None
+        while worker is None:
+            try:
+                worker = self._idle.get(timeout=CANCEL_POLL_SECONDS)
+            except queue.Empty:
+                if cancelled is not None and cancelled.is_set():
+                    with self._lock:
+                        self.queue_depth -= 1
+                    return _failed_job("Test run cancelled", queued)
+        started = time.perf_counter()
+        with self._lock:
+            self.queue_depth -= 1
+            self.busy += 1
+            self.wait_seconds += started - queued
+        try:
+            return worker.run(folder, cancelled)
+        finally:
+            with self._lock:
+                self.busy -= 1
+                self.busy_seconds += time.perf_counter() - started
+            self._idle.put(worker)
+
+    def metrics(self):
+        elapsed = time.perf_counter() - self.started
+        with self._lock:
+            metrics = {
+                "workers": len(self.workers),
+                "busy": self.busy,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "utilisation": round(self.busy_seconds / (elapsed * len(self.workers)), 4) if elapsed else 0.0,
+                "wait_seconds": round(self.wait_seconds, 3),
+            }
+        for worker in self.workers:
+            for key, value in worker.metrics().items():
+                metrics[key] = metrics.get(key, 0) + value
+        return metrics
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
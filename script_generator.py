@@ -1,20 +1,53 @@
 
 import argparse
+import asyncio
+import contextlib
+import contextvars
+import filecmp
+import hashlib
+import heapq
+import inspect
+import itertools
 import json
 import logging
 import os
+import random
+import re
+import shutil
 import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from functools import lru_cache, partial
 from uuid import uuid4
 from unittest.mock import patch
-from openai import OpenAI
-
-os.environ['OPENAI_API_KEY'] = 'your-api-key'
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+from artifact_store import ArtifactStore, spec_hash
+from batch_benchmark import defines_batch_pair
+from compact_log import PAYLOAD_FOLDER, LogSettings, PayloadStore, payload_extra
+from code_extraction import CodeExtractionError, code_response_format, extract_code
+from preflight import check_script
+from prompts import PromptTemplate
+from spec_index import SpecIndex
+from sandbox import (
+    DEFAULT_CPU_SECONDS,
+    DEFAULT_MAX_JOBS_PER_WORKER,
+    DEFAULT_MEMORY_MB,
+    DEFAULT_TEST_TIMEOUT,
+    SandboxPool,
+    TestWorker,
+)
 
 # Constants and templates
 EXAMPLE_UNIT_TEST = r"""
 import unittest
 from unittest.mock import patch
-from generated_script import add_event_to_google_calendar  # Assuming your function is named this
+from generated_script import add_event_to_google_calendar, add_event_to_google_calendar_batch  # Assuming your function is named this
 
 class TestAddEventToGoogleCalendar(unittest.TestCase):
 
@@ -141,99 +174,910 @@ class TestAddEventToGoogleCalendar(unittest.TestCase):
             "eventId": "unique_event_id"
         })
 
+    @patch('generated_script.create_google_calendar_event')
+    def test_batch_agrees_with_single_calls(self, mock_create_google_calendar_event):
+        mock_create_google_calendar_event.return_value = self.valid_output
+        records = [self.valid_input, dict(self.valid_input, calendarId="work")]
+        expected = [add_event_to_google_calendar(record) for record in records]
+        self.assertEqual(add_event_to_google_calendar_batch(records), expected)
+        self.assertEqual(add_event_to_google_calendar_batch([]), [])
+
 
 if __name__ == '__main__':
     unittest.main()
 """
 
 CONSTANT_FUNCTIONAL_GENERATION_GUIDELINES_PROMPT = """
-1. The script should read JSON input from a file named in the format: (unique identifier)_(timestamp)_(script_name)_input.json.
-2. The script should write JSON output to a file named in the format: (unique identifier)_(timestamp)_(script_name)_output.json.
-3. Error logs should be stored in a file named (unique identifier)_error.json, containing the input data that caused the error, the error message, the script name, and the file location.
+1. The script should read and write JSON with the script_runtime module that sits next to it (from script_runtime import run, read_json, write_json, read_records, write_records) instead of defining its own JSON file helpers.
+2. The work for one input record should be a function that takes the input dict and returns the output dict, and the script should end with: if __name__ == "__main__": run(that_function). run() streams JSON lines, or a single JSON document, from a file or stdin to a file or stdout, so scripts chain with pipes and many records go through one process.
+3. Errors should be raised with a message that names the input that caused them; run(..., --errors errors.jsonl) stores failing records with the error message and the script name.
 4. All scripts should handle input and output data in JSON format to ensure easy chaining.
 5. The scripts should include detailed logging and error handling to facilitate debugging.
-6. Use return_gpt_response(prompt: str, return_json: bool) to outsource complex tasks to an LLM.
+6. Import only the standard library, installed packages and script_runtime; no other helper modules exist next to the script.
+7. Next to the per-record function, define its batch form, named like it with a _batch suffix: it takes a list of input dicts and returns the list of output dicts in the same order, exactly what calling the per-record function on each input would return. Where the operation allows, compute it column by column instead of looping over the records, with numpy imported inside try/except ImportError and a plain Python fallback; otherwise it may call the per-record function for each record. Pass it to run: run(that_function, that_function_batch).
 """
 
 EXAMPLE_CODE = r"""
-import json
+import logging
 import requests
 import datetime
-from utils import return_gpt_response
-
-def read_json(file_path):
-    with open(file_path, 'r') as file:
-        return json.load(file)
-
-def write_json(data, file_path):
-    with open(file_path, 'w') as file:
-        json.dump(data, file, indent=4)
-
-def log_error(unique_id, input_data, error_message, script_name):
-    error_log = {
-        "script_name": script_name,
-        "input_data": input_data,
-        "error_message": error_message,
-        "file_location": __file__
+from script_runtime import run
+
+logger = logging.getLogger(__name__)
+
+def process_record(input_data):
+    # Example task 1: API Call
+    api_url = input_data['api_url']
+    api_response = requests.get(api_url, timeout=30)
+    if api_response.status_code != 200:
+        raise Exception(f"API call to {api_url} failed with status code {api_response.status_code}")
+    api_data = api_response.json()
+    logger.info(f"Fetched {api_url}")
+
+    # Example task 2: Data Processing
+    items = api_data.get('items', [])
+    processed_data = {
+        'source': api_url,
+        'item_count': len(items),
+        'names': sorted(item['name'] for item in items if 'name' in item),
     }
-    error_file_path = f"{unique_id}_error.json"
-    write_json(error_log, error_file_path)
 
-def main(input_file, output_file, unique_id):
-    try:
-        # Read input JSON
-        input_data = read_json(input_file)
-        
-        # Example task 1: API Call
-        api_url = input_data['api_url']
-        api_response = requests.get(api_url)
-        if api_response.status_code != 200:
-            raise Exception(f"API call failed with status code {api_response.status_code}")
-        api_data = api_response.json()
-        
-        # Example task 2: Data Processing with LLM Assistance
-        prompt = f"Process the following data and extract relevant information: {json.dumps(api_data, indent=4)}"
-        processed_data = return_gpt_response(prompt=prompt, return_json=True)
-        processed_data = json.loads(processed_data)
-        
-        # Example task 3: Further Processing
-        processed_data['timestamp'] = datetime.datetime.now().isoformat()
-        
-        # Write output JSON
-        write_json(processed_data, output_file)
-        
-    except Exception as e:
-        log_error(unique_id, input_data, str(e), 'example_script.py')
-        raise
+    # Example task 3: Further Processing
+    processed_data['timestamp'] = datetime.datetime.now().isoformat()
+    return processed_data
+
+def process_record_batch(records):
+    # Each record needs its own API call, so nothing here can be done column by column.
+    # Arithmetic over numeric fields would instead build one numpy array per field and
+    # compute every output at once.
+    return [process_record(record) for record in records]
 
 if __name__ == "__main__":
-    unique_id = "unique_series_identifier"
-    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-    input_file = f"{unique_id}_{timestamp}_example_script_input.json"
-    output_file = f"{unique_id}_{timestamp}_example_script_output.json"
-    main(input_file, output_file, unique_id)
+    run(process_record, process_record_batch)
 """
 
 GENERATED_SCRIPTS_FOLDER = "generated_scripts"
 METADATA_FILE = "metadata.json"
-UNIQUE_FOLDER = os.path.join(GENERATED_SCRIPTS_FOLDER, uuid4().hex[:8])
-os.makedirs(UNIQUE_FOLDER, exist_ok=True)
+CHECKPOINT_FILE = "checkpoint.json"
+# generated scripts import this module, so a copy is put next to every one of them
+RUNTIME_MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "script_runtime.py")
+BATCH_BENCHMARK_MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "batch_benchmark.py")
+BATCH_BENCHMARK_TIMEOUT_SECONDS = 60
+CACHE_FOLDER = os.path.join(GENERATED_SCRIPTS_FOLDER, ".llm_cache")
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+BATCH_SUMMARY_FILE = "batch_summary.jsonl"
+DEFAULT_BATCH_WORKERS = 4
+ASYNC_MAX_CONNECTIONS = 32
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_CANDIDATES = 1
+CANDIDATES_FOLDER = "candidates"
+SCRIPT_RESPONSE_FILE = "generated_script.response.json"
+CONTEXT_TOKEN_BUDGET = 2000
+CONTEXT_RECENT_TURNS = 4
+# per-minute request and token limits; override with --rpm / --tpm to match your account tier
+MODEL_RATE_LIMITS = {
+    "gpt-4o": {"requests_per_minute": 500, "tokens_per_minute": 30000},
+}
+DEFAULT_RATE_LIMITS = {"requests_per_minute": 500, "tokens_per_minute": 30000}
+LLM_MAX_RETRIES = 6
+LLM_BACKOFF_BASE_SECONDS = 1.0
+LLM_BACKOFF_MAX_SECONDS = 60.0
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+RUN_REPORT_FILE = "run_report.json"
+BATCH_REPORT_FILE = "batch_report.json"
+# USD per million input and output tokens, used for the cost estimate in run reports
+MODEL_PRICES_PER_MILLION = {
+    "gpt-4o": (2.50, 10.00),
+}
+# input tokens served from the provider's prompt prefix cache are billed at this fraction
+CACHED_INPUT_PRICE_FACTOR = 0.5
+# streamed responses end with a chunk carrying the token usage
+STREAM_OPTIONS = {"include_usage": True}
+MAX_REPAIR_FEEDBACK_CHARS = 4000
+MAX_EXAMPLE_SCRIPT_CHARS = 4000
+UNIT_TESTS_FORMAT = code_response_format("unit_tests")
+PYTHON_CODE_FORMAT = code_response_format("python_code")
+
+# Prompt templates: instructions, guidelines and examples form the system message, which is the
+# same for every job, and the job's own data comes last in the user message.
+SUMMARY_TEMPLATE = PromptTemplate(
+    "summary",
+    """
+Summarise this part of a requirements conversation for a Python function/script.
+Keep every concrete requirement, constraint, name, data format, example value and decision.
+Drop greetings, repeated questions and anything that was later revised.
+""",
+    """
+Summarise this part of a requirements conversation.
+Summary so far: {summary}
+Conversation to add to the summary:
+{turns}
+""",
+)
+DISTILL_TEMPLATE = PromptTemplate(
+    "distill",
+    """
+Rewrite a requirements conversation as one concise, self-contained specification for a Python function/script.
+Include every requirement, input and output field, constraint and example value the user agreed to, and nothing else.
+""",
+    """
+Rewrite the following requirements conversation as one specification:
+{conversation}
+""",
+)
+CLARIFICATION_TEMPLATE = PromptTemplate(
+    "clarification",
+    """
+You are gathering the requirements of a Python function/script from a user.
+Given the current specifications, clarify further details or add new aspects. Only ask exactly one question.
+This process will continue until the user finishes. At NO point in time may you stop asking questions.
+Remember, you are NOT allowed to stop asking questions -- though you should still ask questions that add further clarity to the specifications.
+""",
+    """
+Given the current specifications, ask your next question: {conversation}
+""",
+)
+SCHEMA_TEMPLATE = PromptTemplate(
+    "schema",
+    """
+You write JSON schemas for the input and output of Python functions/scripts.
+Respond with the JSON schema as a JSON object.
+""",
+    """
+Create a JSON schema for the {schema_type} of a function/script that follows this specification: {specifications}
+""",
+)
+UNIT_TEST_TEMPLATE = PromptTemplate(
+    "unit_tests",
+    """
+Create a series of unit tests for a function/script.
+The tests should cover typical cases, edge cases, and erroneous cases.
+Provide the tests in Python unittest format.
+
+Assume that the function being tested has the same name as used in the unit tests. This function will be defined in: 'generated_script.py' so the tests should import the functions from that file.
+
+The function also has a batch form with the same name plus a _batch suffix, which takes a list of input dicts and returns the list of outputs in the same order. Add a test that calls the batch form on several of the typical inputs and checks it returns exactly what calling the function on each input returns, and that an empty list gives an empty list.
+
+You MUST return a json object with the complete test module, as plain Python source, in the 'unit_tests' key of the json object.
+
+Example:
+""" + json.dumps({"unit_tests": EXAMPLE_UNIT_TEST}),
+    """
+Create a series of unit tests for the function/script described below.
+The input schema:
+{input_schema}
+The expected output schema:
+{output_schema}
+
+These schemas are the expected input and output for the function/script that meets these requirements:
+{requirements}
+""",
+)
+SCRIPT_SYSTEM_PROMPT = """
+Here are the guidelines for the python script you'll be generating:
+""" + CONSTANT_FUNCTIONAL_GENERATION_GUIDELINES_PROMPT + """
+You must return a JSON object with the generated function/script, as plain Python source, in the python_code property.
 
-logging.basicConfig(
-    filename=os.path.join(UNIQUE_FOLDER, "function_generation.log"),
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
+Here's an example of the returned json object:
+
+""" + json.dumps({"python_code": EXAMPLE_CODE}) + """
+
+The python_code value must run as it is -- it should include all python libraries required to run the code.
+"""
+SCRIPT_USER_PROMPT = """
+Write the python script for this specification:
+{specifications}
+
+The input schema:
+{input_schema}
+The output schema:
+{output_schema}
+
+Your code must pass the following unit tests:
+{unit_tests}
+{examples}
+"""
+SCRIPT_TEMPLATE = PromptTemplate("script", SCRIPT_SYSTEM_PROMPT, SCRIPT_USER_PROMPT)
+REPAIR_TEMPLATE = PromptTemplate(
+    "repair",
+    SCRIPT_SYSTEM_PROMPT,
+    SCRIPT_USER_PROMPT + """
+Your previous attempt was:
+{previous_code}
+
+It did not pass the unit tests. This is the test output:
+{feedback}
+
+Fix the script so that every unit test passes and return the complete corrected script in the same JSON format.
+""",
 )
+
+# Importing this module has no side effects: run folders are created when a job starts,
+# the OpenAI clients on first use, and logging is left to the caller (see configure_logging).
 logger = logging.getLogger(__name__)
+log_settings = LogSettings()
+
+
+def new_run_folder():
+    return os.path.join(GENERATED_SCRIPTS_FOLDER, uuid4().hex[:8])
+
+
+def configure_logging(folder, level=logging.INFO):
+    # what the command line does: log everything for the run into its folder, in the
+    # format chosen by log_settings
+    create_directory(folder)
+    if log_settings.mode == "compact":
+        log_settings.payload_store = PayloadStore(os.path.join(folder, PAYLOAD_FOLDER))
+    logging.basicConfig(handlers=[log_settings.handler(folder)], level=level)
+
+
+def log_payload(label, payload, separator=": ", level=logging.INFO):
+    # prompts, responses and other bulky text: inline in the text log, stored by content hash
+    # in the compact one (see compact_log)
+    logger.log(level, "%s%s%s", label, separator, payload, extra=payload_extra(label, payload))
+
+
+current_job_log = contextvars.ContextVar("current_job_log", default=None)
 
 
-client = OpenAI()
+class JobLogHandler(logging.Handler):
+    # Hands each record to the log file of the job it was logged from, so jobs sharing
+    # a process (batch workers, the server) each get their own function_generation.log.
+    def emit(self, record):
+        handler = current_job_log.get()
+        if handler is not None:
+            handler.handle(record)
 
 
-def return_gpt_response(message_log=[], prompt="", model="gpt-4o", system_content="", return_json=False, post_response_requirements="", pre_prompt_requirements="", sleep=0, max_tokens=4096): 
-    if message_log == [] and prompt == "":
+_job_log_handler = JobLogHandler()
+
+
+@contextlib.contextmanager
+def job_logging(folder):
+    # httpx is included for its "HTTP Request" lines, which llm_replay reads latencies from
+    for job_logger in (logger, logging.getLogger("httpx")):
+        if _job_log_handler not in job_logger.handlers:
+            job_logger.addHandler(_job_log_handler)
+    create_directory(folder)
+    handler = log_settings.handler(folder)
+    token = current_job_log.set(handler)
+    try:
+        yield
+    finally:
+        current_job_log.reset(token)
+        handler.close()
+
+
+# openai is imported on first use, it makes up most of this module's import time.
+# Retries are handled by request_scheduler so they can honour the shared rate limits.
+client = None
+_client_lock = threading.Lock()
+async_client = None
+_async_client_loop = None
+
+
+def get_client():
+    global client
+    with _client_lock:
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(max_retries=0)
+    return client
+
+
+def get_async_client():
+    # One AsyncOpenAI client (and so one pooled HTTP connection) is shared by every
+    # coroutine on the running event loop. httpx pools are bound to the loop they were
+    # first used on, so a new loop gets a fresh client.
+    global async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if async_client is None or _async_client_loop is not loop:
+        import httpx
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        limits = httpx.Limits(
+            max_connections=ASYNC_MAX_CONNECTIONS,
+            max_keepalive_connections=ASYNC_MAX_CONNECTIONS,
+        )
+        async_client = AsyncOpenAI(max_retries=0, http_client=DefaultAsyncHttpxClient(limits=limits))
+        _async_client_loop = loop
+    return async_client
+
+
+async def close_async_client():
+    global async_client, _async_client_loop
+    if async_client is not None:
+        await async_client.close()
+    async_client = None
+    _async_client_loop = None
+
+
+class OpenAIBackend:
+    # Where chat completions actually come from. Any object with the same create and
+    # async_create methods (returning OpenAI-shaped completions or streams) can replace
+    # it through set_llm_backend, e.g. llm_replay.ReplayBackend for offline benchmarks.
+    def create(self, **completion_args):
+        return get_client().chat.completions.create(**completion_args)
+
+    async def async_create(self, **completion_args):
+        return await get_async_client().chat.completions.create(**completion_args)
+
+
+llm_backend = OpenAIBackend()
+
+
+def set_llm_backend(backend):
+    global llm_backend
+    previous = llm_backend
+    llm_backend = backend
+    return previous
+
+
+class ResponseCache:
+    # Content-addressed on-disk cache of LLM responses. Entries are keyed on a
+    # hash of the completion arguments, so identical prompts are only paid for once.
+    def __init__(self, folder=CACHE_FOLDER, max_bytes=CACHE_MAX_BYTES, max_age_seconds=CACHE_MAX_AGE_SECONDS):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        # "use" reads and writes, "refresh" only writes, "bypass" does neither
+        self.mode = "use"
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(completion_args):
+        key_fields = {
+            "model": completion_args.get("model"),
+            "messages": completion_args.get("messages"),
+            "response_format": completion_args.get("response_format"),
+            "max_tokens": completion_args.get("max_tokens"),
+        }
+        if "n" in completion_args:
+            key_fields["n"] = completion_args["n"]
+        serialized = json.dumps(key_fields, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.json")
+
+    def get(self, key):
+        if self.mode != "use":
+            return None
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age_seconds:
+                os.remove(path)
+                self._count(hit=False)
+                return None
+            with open(path, "r") as file:
+                entry = json.load(file)
+            # touching the entry keeps eviction least-recently-used
+            os.utime(path)
+        except (OSError, ValueError):
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        return entry["response"]
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, key, completion_args, response):
+        if self.mode == "bypass" or response is None:
+            return
+        create_directory(self.folder)
+        entry = {
+            "model": completion_args.get("model"),
+            "created": time.time(),
+            "response": response,
+        }
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(entry, file)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        if not os.path.isdir(self.folder):
+            return 0
+        now = time.time()
+        entries = []
+        removed = 0
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.max_age_seconds:
+                os.remove(path)
+                removed += 1
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            os.remove(path)
+            total_size -= size
+            removed += 1
+        return removed
+
+    def log_stats(self):
+        logger.info(f"LLM response cache ({self.mode}): {self.hits} hits, {self.misses} misses")
+
+
+response_cache = ResponseCache()
+artifact_store = ArtifactStore()
+# passing scripts of similar past specifications, loaded from artifact_store on first search
+spec_index = SpecIndex()
+_spec_index_lock = threading.Lock()
+
+
+# Interactive calls (someone is waiting at the prompt) are served before batch calls.
+request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_INTERACTIVE)
+
+
+class LLMRequestError(Exception):
+    pass
+
+
+class JobCancelledError(Exception):
+    pass
+
+
+# Set by whoever runs the job (e.g. server.py) to stop it at the next LLM call, stage or repair attempt.
+current_cancel_event = contextvars.ContextVar("current_cancel_event", default=None)
+
+
+def check_cancelled():
+    event = current_cancel_event.get()
+    if event is not None and event.is_set():
+        raise JobCancelledError("Job was cancelled")
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now, rate_factor):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate * rate_factor)
+        self.updated = now
+
+    def wait_time(self, amount, now, rate_factor):
+        self._refill(now, rate_factor)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / (self.rate * rate_factor)
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class ModelRateLimiter:
+    # Requests-per-minute and tokens-per-minute buckets for one model. Waiting callers
+    # are served strictly by (priority, arrival). A 429 halves the refill rate and
+    # pauses the model for Retry-After; each success wins a little of the rate back.
+    MIN_RATE_FACTOR = 0.1
+    RECOVERY_STEP = 0.05
+    ASYNC_POLL_SECONDS = 0.05
+
+    def __init__(self, model, requests_per_minute, tokens_per_minute):
+        self.model = model
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.rate_factor = 1.0
+        self.blocked_until = 0.0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def _enqueue(self, priority):
+        ticket = (priority, next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiters, ticket)
+        return ticket
+
+    def _abandon(self, ticket):
+        with self._condition:
+            if ticket in self._waiters:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+            self._condition.notify_all()
+
+    def _try_take(self, ticket, estimated_tokens):
+        # called with the condition held; 0 means the request may go, None means
+        # another caller is ahead, otherwise the number of seconds until capacity frees up
+        if self._waiters[0] != ticket:
+            return None
+        now = time.monotonic()
+        wait = max(
+            self.blocked_until - now,
+            self.requests.wait_time(1, now, self.rate_factor),
+            self.tokens.wait_time(estimated_tokens, now, self.rate_factor),
+        )
+        if wait > 0:
+            return wait
+        self.requests.take(1)
+        self.tokens.take(estimated_tokens)
+        heapq.heappop(self._waiters)
+        self._condition.notify_all()
+        return 0
+
+    def acquire(self, estimated_tokens, priority):
+        ticket = self._enqueue(priority)
+        try:
+            with self._condition:
+                while True:
+                    wait = self._try_take(ticket, estimated_tokens)
+                    if wait == 0:
+                        return
+                    self._condition.wait(timeout=wait)
+        except BaseException:
+            self._abandon(ticket)
+            raise
+
+    async def async_acquire(self, estimated_tokens, priority):
+        ticket = self._enqueue(priority)
+        try:
+            while True:
+                with self._condition:
+                    wait = self._try_take(ticket, estimated_tokens)
+                if wait == 0:
+                    return
+                await asyncio.sleep(min(wait or self.ASYNC_POLL_SECONDS, 1.0))
+        except BaseException:
+            self._abandon(ticket)
+            raise
+
+    def settle(self, estimated_tokens, used_tokens):
+        with self._condition:
+            if used_tokens is not None and used_tokens < estimated_tokens:
+                self.tokens.refund(estimated_tokens - used_tokens)
+            self.rate_factor = min(1.0, self.rate_factor + self.RECOVERY_STEP)
+            self._condition.notify_all()
+
+    def throttle(self, retry_after=None):
+        with self._condition:
+            self.rate_factor = max(self.MIN_RATE_FACTOR, self.rate_factor / 2)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            self._condition.notify_all()
+
+
+def estimate_request_tokens(completion_args):
+    # the API counts max_tokens against the token rate limit up front, so do the same
+    prompt_tokens = sum(
+        static_prompt_tokens(message["content"]) if message["role"] == "system" else count_tokens(message.get("content") or "")
+        for message in completion_args["messages"]
+    )
+    return prompt_tokens + completion_args.get("max_tokens", 0) * completion_args.get("n", 1)
+
+
+def retry_after_seconds(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+
+def is_retryable(error):
+    from openai import APIConnectionError, APIStatusError
+    if isinstance(error, APIConnectionError):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    return False
+
+
+class RequestScheduler:
+    # Sits between the pipeline and the API: one rate limiter per model, and retries
+    # with exponential backoff and full jitter that respect Retry-After.
+    def __init__(self, max_retries=LLM_MAX_RETRIES, base_delay=LLM_BACKOFF_BASE_SECONDS, max_delay=LLM_BACKOFF_MAX_SECONDS):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limit_overrides = {}
+        self.limiters = {}
+        self.retries = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+
+    def limiter(self, model):
+        with self._lock:
+            if model not in self.limiters:
+                limits = dict(MODEL_RATE_LIMITS.get(model, DEFAULT_RATE_LIMITS))
+                limits.update(self.limit_overrides)
+                self.limiters[model] = ModelRateLimiter(model, **limits)
+            return self.limiters[model]
+
+    def _retry_delay(self, error, attempt, limiter):
+        if not is_retryable(error) or attempt >= self.max_retries:
+            return None
+        retry_after = retry_after_seconds(error)
+        if getattr(error, "status_code", None) == 429:
+            with self._lock:
+                self.rate_limited += 1
+            limiter.throttle(retry_after)
+        with self._lock:
+            self.retries += 1
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(backoff, retry_after or 0)
+
+    def _give_up(self, error, completion_args, attempt):
+        logger.error(f"LLM request to {completion_args['model']} failed after {attempt + 1} attempts: {error}")
+        return LLMRequestError(f"LLM request to {completion_args['model']} failed: {error}")
+
+    def call(self, completion_args, request, stats=None, settle=True):
+        # stats, when given, receives the time spent waiting for capacity or backing off and the retry count;
+        # settle=False leaves settling to the caller, as a stream's usage only arrives at its end
+        stats = stats if stats is not None else {}
+        stats.update(queue_seconds=0.0, retries=0)
+        limiter = self.limiter(completion_args["model"])
+        estimated_tokens = estimate_request_tokens(completion_args)
+        attempt = 0
+        while True:
+            check_cancelled()
+            queued = time.perf_counter()
+            limiter.acquire(estimated_tokens, request_priority.get())
+            stats["queue_seconds"] += time.perf_counter() - queued
+            try:
+                result = request()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, limiter)
+                if delay is None:
+                    raise self._give_up(e, completion_args, attempt) from e
+                logger.warning(f"LLM request to {completion_args['model']} failed ({e}); retrying in {delay:.1f}s")
+                time.sleep(delay)
+                stats["queue_seconds"] += delay
+                stats["retries"] += 1
+                attempt += 1
+                continue
+            if settle:
+                limiter.settle(estimated_tokens, usage_tokens(result))
+            return result
+
+    async def async_call(self, completion_args, request, stats=None, settle=True):
+        stats = stats if stats is not None else {}
+        stats.update(queue_seconds=0.0, retries=0)
+        limiter = self.limiter(completion_args["model"])
+        estimated_tokens = estimate_request_tokens(completion_args)
+        attempt = 0
+        while True:
+            check_cancelled()
+            queued = time.perf_counter()
+            await limiter.async_acquire(estimated_tokens, request_priority.get())
+            stats["queue_seconds"] += time.perf_counter() - queued
+            try:
+                result = await request()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, limiter)
+                if delay is None:
+                    raise self._give_up(e, completion_args, attempt) from e
+                logger.warning(f"LLM request to {completion_args['model']} failed ({e}); retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                stats["queue_seconds"] += delay
+                stats["retries"] += 1
+                attempt += 1
+                continue
+            if settle:
+                limiter.settle(estimated_tokens, usage_tokens(result))
+            return result
+
+    def settle_stream(self, completion_args, usage, response):
+        # the usage chunk STREAM_OPTIONS asks for comes last; a backend that sends none is
+        # settled on an estimate from the text received
+        used_tokens = getattr(usage, "total_tokens", None)
+        if used_tokens is None:
+            used_tokens = estimate_request_tokens({**completion_args, "max_tokens": 0}) + count_tokens(response)
+        self.limiter(completion_args["model"]).settle(estimate_request_tokens(completion_args), used_tokens)
+
+    def log_stats(self):
+        logger.info(f"LLM request scheduler: {self.retries} retries, {self.rate_limited} rate-limited responses")
+
+
+def usage_tokens(result):
+    usage = getattr(result, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+request_scheduler = RequestScheduler()
+
+
+# The job and pipeline stage an LLM call belongs to, so calls made anywhere in the
+# pipeline are attributed without passing a collector around.
+current_run_metrics = contextvars.ContextVar("current_run_metrics", default=None)
+current_stage = contextvars.ContextVar("current_stage", default=None)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_prompt_tokens=0):
+    input_price, output_price = MODEL_PRICES_PER_MILLION.get(model, (0.0, 0.0))
+    input_cost = (prompt_tokens - cached_prompt_tokens + cached_prompt_tokens * CACHED_INPUT_PRICE_FACTOR) * input_price
+    return (input_cost + completion_tokens * output_price) / 1_000_000
+
+
+@lru_cache(maxsize=64)
+def static_prompt_tokens(system_content):
+    # system messages come from a handful of templates, so each is only tokenized once
+    return count_tokens(system_content)
+
+
+class RunMetrics:
+    # Collects stage wall times and per-call LLM figures for one job and renders run_report.json.
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.started = time.time()
+        self.stage_seconds = {}
+        self.llm_calls = []
+        self._lock = threading.Lock()
+
+    def record_stage(self, name, seconds):
+        with self._lock:
+            self.stage_seconds.setdefault(name, []).append(round(seconds, 6))
+
+    def record_llm_call(self, call):
+        with self._lock:
+            self.llm_calls.append(call)
+
+    def report(self):
+        with self._lock:
+            stage_seconds = {name: list(values) for name, values in self.stage_seconds.items()}
+            llm_calls = list(self.llm_calls)
+        stages = {}
+        for name in list(stage_seconds) + [call["stage"] for call in llm_calls]:
+            stages.setdefault(name, {
+                "runs": 0, "wall_seconds": 0.0, "llm_calls": 0, "llm_seconds": 0.0, "queue_seconds": 0.0,
+                "prompt_tokens": 0, "cached_prompt_tokens": 0, "static_prompt_tokens": 0, "completion_tokens": 0,
+                "retries": 0, "cache_hits": 0, "cost_usd": 0.0,
+            })
+        for name, values in stage_seconds.items():
+            stages[name]["runs"] = len(values)
+            stages[name]["wall_seconds"] = round(sum(values), 6)
+        for call in llm_calls:
+            stage = stages[call["stage"]]
+            stage["llm_calls"] += 1
+            stage["llm_seconds"] = round(stage["llm_seconds"] + call["wall_seconds"], 6)
+            stage["queue_seconds"] = round(stage["queue_seconds"] + call["queue_seconds"], 6)
+            stage["prompt_tokens"] += call["prompt_tokens"]
+            stage["cached_prompt_tokens"] += call["cached_prompt_tokens"]
+            stage["static_prompt_tokens"] += call["static_prompt_tokens"]
+            stage["completion_tokens"] += call["completion_tokens"]
+            stage["retries"] += call["retries"]
+            stage["cache_hits"] += int(call["cache_hit"])
+            stage["cost_usd"] = round(stage["cost_usd"] + call["cost_usd"], 6)
+        totals = {
+            key: round(sum(stage[key] for stage in stages.values()), 6)
+            for key in (
+                "llm_calls", "llm_seconds", "queue_seconds", "prompt_tokens", "cached_prompt_tokens", "static_prompt_tokens",
+                "completion_tokens", "retries", "cache_hits", "cost_usd",
+            )
+        }
+        totals["wall_seconds"] = round(time.time() - self.started, 6)
+        return {"job_id": self.job_id, "started_at": self.started, "totals": totals, "stages": stages, "llm_calls": llm_calls}
+
+    def save(self, folder):
+        path = os.path.join(folder, RUN_REPORT_FILE)
+        with open(path, "w") as file:
+            json.dump(self.report(), file, indent=4)
+        return path
+
+
+@contextlib.contextmanager
+def instrument_stage(name):
+    # times the enclosed block as a stage of the current job and attributes LLM calls inside it
+    token = current_stage.set(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        current_stage.reset(token)
+        metrics = current_run_metrics.get()
+        if metrics is not None:
+            metrics.record_stage(name, time.perf_counter() - started)
+
+
+def record_llm_call(completion_args, started, usage=None, response=None, cache_hit=False, streamed=False, queue_seconds=0.0, retries=0):
+    metrics = current_run_metrics.get()
+    if metrics is None:
+        return
+    cached_prompt_tokens = 0
+    if usage is not None:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        # the part of the prompt the provider served from its prefix cache
+        cached_prompt_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None) or 0
+    else:
+        prompt_tokens = estimate_request_tokens({**completion_args, "max_tokens": 0})
+        completion_tokens = count_tokens(response) if isinstance(response, str) else 0
+    if cache_hit:
+        # nothing was sent, so nothing was paid for
+        prompt_tokens = completion_tokens = 0
+    # tokens of the system message, the prefix every job's prompts for a stage share
+    system_messages = [message["content"] for message in completion_args["messages"][:1] if message["role"] == "system"]
+    static_tokens = static_prompt_tokens(system_messages[0]) if system_messages and prompt_tokens else 0
+    model = completion_args["model"]
+    metrics.record_llm_call({
+        "stage": current_stage.get() or "unstaged",
+        "model": model,
+        "wall_seconds": round(time.perf_counter() - started, 6),
+        "queue_seconds": round(queue_seconds, 6),
+        "prompt_tokens": prompt_tokens,
+        "cached_prompt_tokens": cached_prompt_tokens,
+        "static_prompt_tokens": static_tokens,
+        "completion_tokens": completion_tokens,
+        "retries": retries,
+        "cache_hit": cache_hit,
+        "streamed": streamed,
+        "cost_usd": round(estimate_cost(model, prompt_tokens, completion_tokens, cached_prompt_tokens), 6),
+    })
+
+
+def aggregate_run_reports(reports):
+    # batch-level view: latency percentiles per stage plus summed tokens, retries and cost
+    stage_seconds = {}
+    totals = {}
+    for report in reports:
+        for name, stage in report["stages"].items():
+            if stage["runs"]:
+                stage_seconds.setdefault(name, []).append(stage["wall_seconds"])
+        for key, value in report["totals"].items():
+            totals[key] = round(totals.get(key, 0) + value, 6)
+    stages = {
+        name: {
+            "jobs": len(values),
+            "p50_seconds": round(percentile(values, 0.50), 6),
+            "p95_seconds": round(percentile(values, 0.95), 6),
+            "p99_seconds": round(percentile(values, 0.99), 6),
+            "max_seconds": round(max(values), 6),
+        }
+        for name, values in stage_seconds.items()
+    }
+    job_seconds = [report["totals"]["wall_seconds"] for report in reports]
+    return {
+        "jobs": len(reports),
+        "job_p50_seconds": round(percentile(job_seconds, 0.50), 6) if job_seconds else None,
+        "job_p95_seconds": round(percentile(job_seconds, 0.95), 6) if job_seconds else None,
+        "job_p99_seconds": round(percentile(job_seconds, 0.99), 6) if job_seconds else None,
+        "totals": totals,
+        "stages": stages,
+    }
+
+
+def build_completion_args(message_log=None, prompt="", model="gpt-4o", system_content="", return_json=False, max_tokens=4096, n=1, response_format=None):
+    if not message_log and prompt == "":
         raise ValueError("Both message_log and prompt cannot be empty when calling return_gpt_response.")
     
+    # copy so neither the caller's list nor a shared default accumulates messages between calls
+    message_log = list(message_log or [])
     if message_log == []:
         message_log.append({"role": "system", "content": system_content})
     else:
@@ -243,252 +1087,1611 @@ def return_gpt_response(message_log=[], prompt="", model="gpt-4o", system_conten
     if prompt != "":
         message_log.append({"role": "user", "content": prompt})
 
-    try:
-        if sleep:
-            sleep_time = random.randint(sleep, sleep*2)
-            time.sleep(sleep_time)
-
-        completion_args = {
-            "model": model,
-            "messages": message_log,
-            "max_tokens": max_tokens
-        }
-        
-        if return_json:
-            completion_args["response_format"] = {"type": "json_object"}
+    completion_args = {
+        "model": model,
+        "messages": message_log,
+        "max_tokens": max_tokens
+    }
+    
+    # response_format is a JSON schema the response must follow; return_json only asks for any JSON object
+    if response_format:
+        completion_args["response_format"] = response_format
+    elif return_json:
+        completion_args["response_format"] = {"type": "json_object"}
+    if n > 1:
+        completion_args["n"] = n
+    return completion_args
+
+
+def completion_content(chat_completion, n=1):
+    if n > 1:
+        return [choice.message.content for choice in chat_completion.choices]
+    return chat_completion.choices[0].message.content
+
+
+def return_gpt_response(message_log=None, prompt="", model="gpt-4o", system_content="", return_json=False, post_response_requirements="", pre_prompt_requirements="", sleep=0, max_tokens=4096, n=1, on_token=None, response_format=None): 
+    # with n > 1 a list of n alternative responses is returned instead of a single one;
+    # with on_token the response is streamed and on_token is called with every chunk
+    if on_token is not None:
+        return collect_stream(stream_gpt_response(message_log, prompt, model, system_content, return_json, max_tokens, response_format), on_token)
+    completion_args = build_completion_args(message_log, prompt, model, system_content, return_json, max_tokens, n, response_format)
+
+    if sleep:
+        sleep_time = random.randint(sleep, sleep*2)
+        time.sleep(sleep_time)
+
+    started = time.perf_counter()
+    cache_key = response_cache.make_key(completion_args)
+    cached_response = response_cache.get(cache_key)
+    if cached_response is not None:
+        record_llm_call(completion_args, started, cache_hit=True)
+        return cached_response
+
+    stats = {}
+    chat_completion = request_scheduler.call(
+        completion_args, lambda: llm_backend.create(**completion_args), stats
+    )
 
-        chat_completion = client.chat.completions.create(**completion_args)
-        
+    response = completion_content(chat_completion, n)
+    record_llm_call(completion_args, started, usage=getattr(chat_completion, "usage", None), response=response, **stats)
+    response_cache.put(cache_key, completion_args, response)
+    return response
+
+
+async def async_return_gpt_response(message_log=None, prompt="", model="gpt-4o", system_content="", return_json=False, post_response_requirements="", pre_prompt_requirements="", sleep=0, max_tokens=4096, n=1, on_token=None, response_format=None):
+    if on_token is not None:
+        return await async_collect_stream(async_stream_gpt_response(message_log, prompt, model, system_content, return_json, max_tokens, response_format), on_token)
+    completion_args = build_completion_args(message_log, prompt, model, system_content, return_json, max_tokens, n, response_format)
+
+    if sleep:
+        await asyncio.sleep(random.randint(sleep, sleep*2))
+
+    started = time.perf_counter()
+    cache_key = response_cache.make_key(completion_args)
+    cached_response = response_cache.get(cache_key)
+    if cached_response is not None:
+        record_llm_call(completion_args, started, cache_hit=True)
+        return cached_response
+
+    stats = {}
+    chat_completion = await request_scheduler.async_call(
+        completion_args, lambda: llm_backend.async_create(**completion_args), stats
+    )
+
+    response = completion_content(chat_completion, n)
+    record_llm_call(completion_args, started, usage=getattr(chat_completion, "usage", None), response=response, **stats)
+    response_cache.put(cache_key, completion_args, response)
+    return response
+
+
+def stream_content(chunk):
+    if not chunk.choices:
+        return ""
+    return chunk.choices[0].delta.content or ""
+
+
+def stream_gpt_response(message_log=None, prompt="", model="gpt-4o", system_content="", return_json=False, max_tokens=4096, response_format=None):
+    # Yields the response text chunk by chunk as the API produces it. A cached
+    # response is yielded as a single chunk; a completed stream is cached whole.
+    completion_args = build_completion_args(message_log, prompt, model, system_content, return_json, max_tokens, response_format=response_format)
+    started = time.perf_counter()
+    cache_key = response_cache.make_key(completion_args)
+    cached_response = response_cache.get(cache_key)
+    if cached_response is not None:
+        record_llm_call(completion_args, started, cache_hit=True, streamed=True)
+        yield cached_response
+        return
+
+    # only opening the stream is retried; once text has been handed out a failure is final
+    stats = {}
+    stream = request_scheduler.call(
+        completion_args, lambda: llm_backend.create(stream=True, stream_options=STREAM_OPTIONS, **completion_args), stats, settle=False
+    )
+    chunks = []
+    usage = None
+    try:
+        for chunk in stream:
+            usage = getattr(chunk, "usage", None) or usage
+            content = stream_content(chunk)
+            if content:
+                chunks.append(content)
+                yield content
     except Exception as e:
-        print("An error occurred")
-        print(e)
+        logger.error(f"LLM stream from {model} failed: {e}")
+        raise LLMRequestError(f"LLM stream from {model} failed: {e}") from e
+
+    response = "".join(chunks)
+    request_scheduler.settle_stream(completion_args, usage, response)
+    record_llm_call(completion_args, started, usage=usage, response=response, streamed=True, **stats)
+    response_cache.put(cache_key, completion_args, response)
+
+
+async def async_stream_gpt_response(message_log=None, prompt="", model="gpt-4o", system_content="", return_json=False, max_tokens=4096, response_format=None):
+    completion_args = build_completion_args(message_log, prompt, model, system_content, return_json, max_tokens, response_format=response_format)
+    started = time.perf_counter()
+    cache_key = response_cache.make_key(completion_args)
+    cached_response = response_cache.get(cache_key)
+    if cached_response is not None:
+        record_llm_call(completion_args, started, cache_hit=True, streamed=True)
+        yield cached_response
         return
 
-    response = chat_completion.choices[0].message.content
-    return response
+    stats = {}
+    stream = await request_scheduler.async_call(
+        completion_args, lambda: llm_backend.async_create(stream=True, stream_options=STREAM_OPTIONS, **completion_args), stats, settle=False
+    )
+    chunks = []
+    usage = None
+    try:
+        async for chunk in stream:
+            usage = getattr(chunk, "usage", None) or usage
+            content = stream_content(chunk)
+            if content:
+                chunks.append(content)
+                yield content
+    except Exception as e:
+        logger.error(f"LLM stream from {model} failed: {e}")
+        raise LLMRequestError(f"LLM stream from {model} failed: {e}") from e
+
+    response = "".join(chunks)
+    request_scheduler.settle_stream(completion_args, usage, response)
+    record_llm_call(completion_args, started, usage=usage, response=response, streamed=True, **stats)
+    response_cache.put(cache_key, completion_args, response)
+
+
+def collect_stream(chunks, on_token):
+    collected = []
+    for chunk in chunks:
+        on_token(chunk)
+        collected.append(chunk)
+    return "".join(collected) or None
+
+
+async def async_collect_stream(chunks, on_token):
+    collected = []
+    async for chunk in chunks:
+        on_token(chunk)
+        collected.append(chunk)
+    return "".join(collected) or None
+
+
+def print_token(token):
+    print(token, end="", flush=True)
 
 
 def create_directory(path: str):
     os.makedirs(path, exist_ok=True)
 
 
+def install_runtime(folder):
+    # an older copy is replaced, a resumed or reused folder gets the current runtime
+    path = os.path.join(folder, os.path.basename(RUNTIME_MODULE))
+    if not os.path.exists(path) or not filecmp.cmp(RUNTIME_MODULE, path, shallow=False):
+        shutil.copyfile(RUNTIME_MODULE, path)
+
+
+# Records a passing script's scalar and _batch functions are timed on. 0, the default, skips
+# the benchmark: it calls the generated code for real, without the mocks of its unit tests,
+# so a script that makes HTTP or LLM requests or writes files would do so once per record.
+batch_benchmark_records = 0
+
+
+def benchmark_batch(output_folder, script):
+    # Runs batch_benchmark.py on the final script in a process of its own: it imports
+    # generated code and feeds it records sampled from the input schema.
+    if batch_benchmark_records <= 0:
+        return None
+    if not defines_batch_pair(script):
+        logger.info("Batch benchmark skipped: the script defines no function with a _batch form")
+        return {"skipped": "the script defines no function with a _batch form"}
+    with instrument_stage("batch_benchmark"):
+        try:
+            completed = subprocess.run(
+                [sys.executable, BATCH_BENCHMARK_MODULE, output_folder, "--records", str(batch_benchmark_records)],
+                capture_output=True, text=True, timeout=BATCH_BENCHMARK_TIMEOUT_SECONDS,
+            )
+        except subprocess.TimeoutExpired:
+            result = {"skipped": f"timed out after {BATCH_BENCHMARK_TIMEOUT_SECONDS} seconds"}
+        else:
+            lines = completed.stdout.strip().splitlines()
+            if completed.returncode != 0 or not lines:
+                errors = completed.stderr.strip().splitlines()
+                result = {"skipped": errors[-1] if errors else f"exit code {completed.returncode}"}
+            else:
+                # the script may print while it is imported, the benchmark's own output is the last line
+                result = json.loads(lines[-1])
+    for comparison in result.get("results", []):
+        if "speedup" in comparison:
+            level = logging.INFO if comparison["agree"] else logging.WARNING
+            logger.log(
+                level,
+                f"{comparison['function']}_batch is {comparison['speedup']}x the speed of {comparison['function']} "
+                f"on {comparison['records']} sampled records; the outputs {'agree' if comparison['agree'] else 'DIFFER'}",
+            )
+        else:
+            logger.info(f"Batch benchmark of {comparison['function']} skipped: {comparison['skipped']}")
+    if "skipped" in result:
+        logger.info(f"Batch benchmark skipped: {result['skipped']}")
+    return result
+
+
+# None runs every test file in a fresh `python` subprocess; otherwise an object with a
+# run(folder, cancelled=None) method that returns structured results and stops early once
+# the cancelled threading.Event is set (sandbox.TestWorker or SandboxPool).
+test_runner = None
+TEST_RUNNERS = ["subprocess", "inprocess", "pool"]
+
+
+def set_test_runner(runner):
+    global test_runner
+    if test_runner is not None:
+        logger.info(f"Test runner metrics: {json.dumps(test_runner.metrics())}")
+        test_runner.close()
+    test_runner = runner
+
+
+def add_test_runner_arguments(parser, default="subprocess"):
+    # the --test-runner and sandbox flags shared by script_generator.py, server.py and benchmark.py
+    parser.add_argument(
+        "--test-runner",
+        choices=TEST_RUNNERS,
+        default=default,
+        help="Run generated tests in a fresh interpreter per run, inside one reusable worker process, or on a pool of pre-started workers.",
+    )
+    parser.add_argument(
+        "--test-timeout",
+        type=float,
+        default=DEFAULT_TEST_TIMEOUT,
+        help="Seconds a single in-process test run may take before its worker is killed.",
+    )
+    parser.add_argument(
+        "--sandbox-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of pre-started test workers for --test-runner pool.",
+    )
+    parser.add_argument(
+        "--sandbox-cpu-seconds",
+        type=int,
+        default=DEFAULT_CPU_SECONDS,
+        help="CPU seconds a single test run may use in a worker.",
+    )
+    parser.add_argument(
+        "--sandbox-memory-mb",
+        type=int,
+        default=DEFAULT_MEMORY_MB,
+        help="Address space limit of each test worker in megabytes.",
+    )
+    parser.add_argument(
+        "--sandbox-max-jobs",
+        type=int,
+        default=DEFAULT_MAX_JOBS_PER_WORKER,
+        help="Recycle a test worker after this many test runs.",
+    )
+
+
+def check_test_runner_arguments(parser, args):
+    if args.test_runner == "pool" and args.sandbox_workers < 1:
+        parser.error("--sandbox-workers must be at least 1")
+
+
+def test_runner_from_arguments(args):
+    # None keeps the default of a fresh interpreter per test run
+    sandbox_limits = {
+        "timeout": args.test_timeout,
+        "cpu_seconds": args.sandbox_cpu_seconds,
+        "memory_mb": args.sandbox_memory_mb,
+        "max_jobs": args.sandbox_max_jobs,
+    }
+    if args.test_runner == "inprocess":
+        return TestWorker(**sandbox_limits)
+    if args.test_runner == "pool":
+        return SandboxPool(workers=args.sandbox_workers, **sandbox_limits)
+    return None
+
+
 class FunctionGenerationError(Exception):
     pass
 
 
-class SpecGathering:
+class StageScheduler:
+    # Runs pipeline stages as soon as the stages they depend on have finished, so
+    # independent LLM calls overlap. Stage results and wall times are kept by name.
     def __init__(self):
+        self.stages = {}
+        self.results = {}
+        self.timings = {}
+
+    def add_stage(self, name, func, depends_on=()):
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}")
+        self.stages[name] = (func, tuple(depends_on))
+
+    def _ready_stages(self, pending, finished):
+        ready = [name for name in pending if all(dep in finished for dep in self.stages[name][1])]
+        for name in ready:
+            pending.remove(name)
+        return ready
+
+    def _timed(self, name):
+        check_cancelled()
+        func = self.stages[name][0]
+        started = time.perf_counter()
+        with instrument_stage(name):
+            result = func()
+        self._record(name, started, result)
+        return result
+
+    async def _async_timed(self, name):
+        check_cancelled()
+        func = self.stages[name][0]
+        started = time.perf_counter()
+        with instrument_stage(name):
+            result = func()
+            if inspect.isawaitable(result):
+                result = await result
+        self._record(name, started, result)
+        return result
+
+    def _record(self, name, started, result):
+        self.results[name] = result
+        self.timings[name] = round(time.perf_counter() - started, 3)
+        logger.info(f"Stage {name} finished in {self.timings[name]}s")
+
+    def run(self):
+        pending = list(self.stages)
+        finished = set()
+        with ThreadPoolExecutor(max_workers=max(len(self.stages), 1)) as executor:
+            # stages run with the caller's context so settings like request_priority carry over
+            running = {
+                executor.submit(contextvars.copy_context().run, self._timed, name): name
+                for name in self._ready_stages(pending, finished)
+            }
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    # re-raises the stage's own exception; stages not yet started never run
+                    future.result()
+                    finished.add(name)
+                for name in self._ready_stages(pending, finished):
+                    running[executor.submit(contextvars.copy_context().run, self._timed, name)] = name
+        if pending:
+            raise ValueError(f"Stages {pending} could not be scheduled because of a dependency cycle")
+        return self.results
+
+    async def async_run(self):
+        pending = list(self.stages)
+        finished = set()
+        running = {
+            asyncio.ensure_future(self._async_timed(name)): name
+            for name in self._ready_stages(pending, finished)
+        }
+        try:
+            while running:
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    task.result()
+                    finished.add(name)
+                for name in self._ready_stages(pending, finished):
+                    running[asyncio.ensure_future(self._async_timed(name))] = name
+        finally:
+            for task in running:
+                task.cancel()
+        if pending:
+            raise ValueError(f"Stages {pending} could not be scheduled because of a dependency cycle")
+        return self.results
+
+
+@lru_cache(maxsize=None)
+def _token_encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text, model="gpt-4o"):
+    if tiktoken is not None:
+        return len(_token_encoding(model).encode(text))
+    # without tiktoken, roughly four characters per token for English text and code
+    return (len(text) + 3) // 4
+
+
+class ConversationContext:
+    # Keeps the requirement conversation inside a token budget: the most recent turns
+    # stay verbatim and older ones are folded into a rolling LLM-written summary.
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET, recent_turns=CONTEXT_RECENT_TURNS):
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.summary = ""
+        self.turns = []
+        self.transcript = ""
+        self.tokens_saved = 0
+
+    def add(self, role, text):
+        self.turns.append(f"{role}: {text}")
+        self.transcript += f"\n{role}: {text}"
+
+    def render(self):
+        parts = []
+        if self.summary:
+            parts.append(f"Summary of the earlier conversation: {self.summary}")
+        parts.extend(self.turns)
+        return "\n" + "\n".join(parts)
+
+    def prompt_context(self):
+        rendered = self.render()
+        self.tokens_saved += count_tokens(self.transcript) - count_tokens(rendered)
+        return rendered
+
+    def _needs_compaction(self):
+        return len(self.turns) > self.recent_turns and count_tokens(self.render()) > self.token_budget
+
+    def _summary_prompt(self):
+        older_turns = "\n".join(self.turns[:-self.recent_turns])
+        return SUMMARY_TEMPLATE.arguments(summary=self.summary or "(none)", turns=older_turns)
+
+    def _apply_summary(self, summary):
+        if summary:
+            self.summary = summary
+            self.turns = self.turns[-self.recent_turns:]
+
+    def compact(self):
+        if self._needs_compaction():
+            self._apply_summary(return_gpt_response(**self._summary_prompt()))
+
+    async def async_compact(self):
+        if self._needs_compaction():
+            self._apply_summary(await async_return_gpt_response(**self._summary_prompt()))
+
+    def _needs_distillation(self):
+        return count_tokens(self.transcript) > self.token_budget
+
+    def _distill_prompt(self):
+        return DISTILL_TEMPLATE.arguments(conversation=self.render())
+
+    def distill(self):
+        # short conversations are passed on as they are; only an over-budget one costs an extra call
+        if not self._needs_distillation():
+            return self.transcript
+        return return_gpt_response(**self._distill_prompt()) or self.transcript
+
+    async def async_distill(self):
+        if not self._needs_distillation():
+            return self.transcript
+        return await async_return_gpt_response(**self._distill_prompt()) or self.transcript
+
+
+class SpecGathering:
+    def __init__(self, output_folder, token_budget=CONTEXT_TOKEN_BUDGET):
+        self.output_folder = output_folder
+        create_directory(self.output_folder)
         self.specifications = ""
+        self.transcript = ""
         self.input_schema = {}
         self.output_schema = {}
+        self.context = ConversationContext(token_budget=token_budget)
+
+    def _clarification_prompt(self):
+        return CLARIFICATION_TEMPLATE.arguments(conversation=self.context.prompt_context())
+
+    def _add_turn(self, role, text):
+        self.specifications += f"\n{role}: {text}"
+        self.context.add(role, text)
+
+    def _use_distilled_specifications(self, distilled):
+        self.transcript = self.specifications
+        self.specifications = distilled
+        log_payload("Distilled specification", self.specifications)
+        logger.info(f"Requirement context: {json.dumps(self.token_report())}")
+
+    def token_report(self):
+        # tokens each downstream prompt saves by embedding the distilled spec instead of the transcript
+        transcript_tokens = count_tokens(self.transcript or self.specifications)
+        specification_tokens = count_tokens(self.specifications)
+        return {
+            "transcript_tokens": transcript_tokens,
+            "specification_tokens": specification_tokens,
+            "saved_per_prompt": transcript_tokens - specification_tokens,
+            "saved_during_gathering": self.context.tokens_saved,
+        }
 
     def gather_requirements(self):
         prompt = "Welcome! Let's gather requirements by using the dialectic method -- the LLM will ask one question at a time. Oh user, please describe the key functionality:"
         print("Please provide the key functionality of the script. Don't worry about being brief, the script will keep asking you questions until you're satisfied.")
         while True:
             user_input = input("Your input (or type 'done' to finish): ")
-            self.specifications += f"\nUser: {user_input}"
-            prompt = f"Given the current specifications, clarify further details or add new aspects. Only ask exactly one question. This process will continue until the user finishes. At NO point in time may you stop asking questions.: {self.specifications}\nRemember, you are NOT allowed to stop asking questions -- though you should still ask questions that add further clarity to the specifications."
+            self._add_turn("User", user_input)
             if user_input.lower() == "done":
                 break
-            response = return_gpt_response(prompt=prompt)
-            print(f"LLM: {response}")
-            self.specifications += f"\nLLM: {response}"
+            self.context.compact()
+            prompt = self._clarification_prompt()
+            print("LLM: ", end="", flush=True)
+            response = return_gpt_response(**prompt, on_token=print_token)
+            print()
+            self._add_turn("LLM", response)
             
-            logger.info(f"Gathering requirements: {self.specifications}")
+            log_payload("Gathering requirements", self.specifications)
+        self._use_distilled_specifications(self.context.distill())
 
-    def generate_schema(self, schema_type="input"):
+    async def async_gather_requirements(self):
+        print("Please provide the key functionality of the script. Don't worry about being brief, the script will keep asking you questions until you're satisfied.")
+        while True:
+            user_input = await asyncio.to_thread(input, "Your input (or type 'done' to finish): ")
+            self._add_turn("User", user_input)
+            if user_input.lower() == "done":
+                break
+            await self.context.async_compact()
+            print("LLM: ", end="", flush=True)
+            response = await async_return_gpt_response(**self._clarification_prompt(), on_token=print_token)
+            print()
+            self._add_turn("LLM", response)
+
+            log_payload("Gathering requirements", self.specifications)
+        self._use_distilled_specifications(await self.context.async_distill())
+
+    def _schema_prompt(self, schema_type):
         assert schema_type in ["input", "output"], "Invalid schema type"
-        prompt = f"Create a JSON schema for the {schema_type} of a function/script that follows this specification: {self.specifications}"
-        schema_response = return_gpt_response(prompt=prompt, return_json=True)
+        return SCHEMA_TEMPLATE.arguments(schema_type=schema_type, specifications=self.specifications)
+
+    def _store_schema(self, schema_response, schema_type):
         schema = json.loads(schema_response)
         if schema_type == "input":
             self.input_schema = schema
         else:
             self.output_schema = schema
-        logger.info(f"Generated {schema_type} schema: {schema}")
+        log_payload(f"Generated {schema_type} schema", schema)
+
+    def generate_schema(self, schema_type="input"):
+        prompt = self._schema_prompt(schema_type)
+        schema_response = return_gpt_response(**prompt, return_json=True)
+        self._store_schema(schema_response, schema_type)
+
+    async def async_generate_schema(self, schema_type="input"):
+        prompt = self._schema_prompt(schema_type)
+        schema_response = await async_return_gpt_response(**prompt, return_json=True)
+        self._store_schema(schema_response, schema_type)
 
     def save_schema(self, schema, schema_type="input"):
-        filename = os.path.join(UNIQUE_FOLDER, f"{schema_type}_schema.json")
+        filename = os.path.join(self.output_folder, f"{schema_type}_schema.json")
         with open(filename, "w") as file:
             json.dump(schema, file, indent=4)
         logger.info(f"Saved {schema_type} schema to {filename}")
 
 
-def escape_code(code: str) -> str:
-    return repr(code)
-
-
-def unescape_code(escaped_string: str) -> str:
-    decoded_string = escaped_string.replace("\\n", "\n").replace("\\'", "'").replace('\\"', '"')
-    return decoded_string
-
-
 class UnitTestGenerator:
-    def __init__(self, input_schema, output_schema):
+    def __init__(self, input_schema, output_schema, output_folder):
+        self.output_folder = output_folder
+        create_directory(self.output_folder)
         self.input_schema = input_schema
         self.output_schema = output_schema
         self.unit_tests = []
 
-    def generate_unit_tests(self, requirements):
-        prompt = f"""
-        Create a series of unit tests for a function/script. 
-        The function/script specification:
-        {json.dumps(self.input_schema, indent=4)}
-        The expected output schema:
-        {json.dumps(self.output_schema, indent=4)}
-        The tests should cover typical cases, edge cases, and erroneous cases. 
-        Provide the tests in Python unittest format.
-
-        Note that these schemas are the expected input and output for the function/script that meet these requirements:
-        {requirements}
-
-        You MUST return a json object that contains the unit tests in Python unittest format, Make sure that the escaped code can be put through the 'unescape_code' function to get the results. Put those tests in the 'unit_tests' key of the json object.
-
-        Example:
-        {{"unit_tests": {escape_code(EXAMPLE_UNIT_TEST)}}}
-
-        Make special note that the tests should be escaped like they are in the example.
-
-        Assume that the function being tested has the same name as used in the unit tests. This function will be defined in: 'generated_script.py' so the tests should import the functions from that file.
-        """
-
-        logger.info(f"Generating unit tests with prompt:\n{prompt}")
-
-        response = return_gpt_response(prompt=prompt, return_json=True)
-
-        logger.info(f"Raw LLM response: {response}")
+    def _unit_test_prompt(self, requirements):
+        return UNIT_TEST_TEMPLATE.arguments(
+            input_schema=json.dumps(self.input_schema, indent=4),
+            output_schema=json.dumps(self.output_schema, indent=4),
+            requirements=requirements,
+        )
 
+    def _store_unit_tests(self, response):
+        log_payload("Raw LLM response", response)
         try:
-            response_json = json.loads(response)
-            escaped_unit_tests = response_json['unit_tests']
-            self.unit_tests = unescape_code(escaped_unit_tests)
-            logger.info(f"Generated unit tests: {self.unit_tests}")
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to decode JSON response: {e}")
-            logger.error(f"Response content: {response}")
-            raise
-        except KeyError as e:
-            logger.error(f"Missing expected key in JSON response: {e}")
-            logger.error(f"Response content: {response}")
+            self.unit_tests = extract_code(response, "unit_tests")
+        except CodeExtractionError as e:
+            logger.error(f"Unusable unit tests in the response: {e}")
             raise
+        log_payload("Generated unit tests", self.unit_tests)
+
+    def generate_unit_tests(self, requirements):
+        prompt = self._unit_test_prompt(requirements)
+        log_payload("Generating unit tests with prompt", prompt["prompt"], separator=":\n")
+        response = return_gpt_response(**prompt, response_format=UNIT_TESTS_FORMAT)
+        self._store_unit_tests(response)
+
+    async def async_generate_unit_tests(self, requirements):
+        prompt = self._unit_test_prompt(requirements)
+        log_payload("Generating unit tests with prompt", prompt["prompt"], separator=":\n")
+        response = await async_return_gpt_response(**prompt, response_format=UNIT_TESTS_FORMAT)
+        self._store_unit_tests(response)
 
     def save_unit_tests(self):
-        file_name = os.path.join(UNIQUE_FOLDER, "test_script.py")
+        file_name = os.path.join(self.output_folder, "test_script.py")
         with open(file_name, "w") as file:
             file.write(self.unit_tests)
         logger.info(f"Saved unit tests to {file_name}")
 
 
 class ScriptGenerator:
-    def __init__(self, specifications, input_schema, output_schema, unit_tests):
+    def __init__(self, specifications, input_schema, output_schema, unit_tests, output_folder, examples=None):
+        # the stages of a job share its run folder (see WorkflowRun), so they take it explicitly
+        self.output_folder = output_folder
+        create_directory(self.output_folder)
         self.specifications = specifications
         self.input_schema = input_schema
         self.output_schema = output_schema
         self.unit_tests = unit_tests
+        # passing scripts of similar specifications (see find_similar_scripts)
+        self.examples = examples or []
+        self.reused_from = None
+        # set when a passing script was loaded from a checkpoint instead of generated
+        self.restored = False
         self.function_code = ""
+        self.test_output = ""
+        self.test_results = []
+        self.attempts = 0
+        self.passed = False
+
+    def _script_values(self):
+        # ordered in the user message from the most to the least stable, so repair attempts
+        # of a job share everything up to the previous code
+        return {
+            "specifications": self.specifications,
+            "input_schema": json.dumps(self.input_schema, indent=4),
+            "output_schema": json.dumps(self.output_schema, indent=4),
+            "unit_tests": self.unit_tests,
+            "examples": self._examples_prompt(),
+        }
 
-    def generate_script(self):
-        prompt = f"""
-        Here are the guidelines for the python script you'll be generating:
-        {CONSTANT_FUNCTIONAL_GENERATION_GUIDELINES_PROMPT}
-        
-        Following this specification:
-        {self.specifications}
-
-        The input schema:
-        {json.dumps(self.input_schema, indent=4)}
-        The output schema:
-        {json.dumps(self.output_schema, indent=4)}
-
-        Your code must pass the following unit tests:
-        {self.unit_tests}
-
-        You must return a JSON object with the generated function/script in the python_code property.
-
-        Here's an example of the returned json object:
-
-        {{"python_code": "{escape_code(EXAMPLE_CODE)}"}}
-
-        Just respond with the code such that it can be run directly after escaping it -- it should include all python libraries required to run the code.
+    def _examples_prompt(self):
+        if not self.examples:
+            return ""
+        examples = "\n".join(
+            f"""
+        Specification: {example["specification"]}
+        Script:
+        {example["script"][:MAX_EXAMPLE_SCRIPT_CHARS]}
         """
-        
-        logger.info(f"Generating script with prompt:\n{prompt}")
+            for example in self.examples
+        )
+        return f"""
+        These scripts passed the unit tests of similar specifications. Reuse whatever applies:
+        {examples}
+        """
+
+    def _repair_prompt(self, previous_code, test_output):
+        # keep the tail of the output, that's where unittest puts the failure summary
+        feedback = test_output[-MAX_REPAIR_FEEDBACK_CHARS:]
+        return REPAIR_TEMPLATE.arguments(**self._script_values(), previous_code=previous_code, feedback=feedback)
 
+    def _parse_function_code(self, response):
+        log_payload("Raw LLM response", response)
         try:
-            response = return_gpt_response(prompt=prompt, return_json=True)
-            logger.info(f"Raw LLM response: {response}")
-
-            response_json = json.loads(response)
-            escaped_function_code = response_json['python_code']
-            function_code = unescape_code(escaped_function_code)
-            # strip the leading and trailing quotes
-            function_code = function_code.strip('"').strip("'")
-            self.function_code = function_code
-
-            logger.info(f"Generated function code: {self.function_code}")
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to decode JSON response: {e}")
-            logger.error(f"Response content: {response}")
-            raise
-        except KeyError as e:
-            logger.error(f"Missing expected key in JSON response: {e}")
-            logger.error(f"Response content: {response}")
+            function_code = extract_code(response, "python_code")
+        except CodeExtractionError as e:
+            logger.error(f"Unusable script in the response: {e}")
             raise
+        log_payload("Generated function code", function_code)
+        return function_code
+
+    def _store_function_code(self, response):
+        self.function_code = self._parse_function_code(response)
+
+    def _parse_candidates(self, responses):
+        candidates = []
+        for response in responses:
+            try:
+                candidates.append(self._parse_function_code(response))
+            except (ValueError, KeyError, TypeError):
+                continue
+        if not candidates:
+            raise ValueError(f"None of the {len(responses)} candidate responses could be parsed")
+        return candidates
+
+    def _generation_prompt(self, previous_code=None, test_output=None):
+        if previous_code is None:
+            prompt = SCRIPT_TEMPLATE.arguments(**self._script_values())
+        else:
+            prompt = self._repair_prompt(previous_code, test_output)
+        log_payload("Generating script with prompt", prompt["prompt"], separator=":\n")
+        return prompt
+
+    def _response_file(self):
+        # the raw response is streamed to disk as it arrives, so a long generation can be
+        # followed (or inspected after a crash) before the JSON is complete
+        return open(os.path.join(self.output_folder, SCRIPT_RESPONSE_FILE), "w")
+
+    def _write_chunk(self, response_file, chunk):
+        response_file.write(chunk)
+        response_file.flush()
+
+    def generate_script(self, previous_code=None, test_output=None):
+        prompt = self._generation_prompt(previous_code, test_output)
+        with self._response_file() as response_file:
+            response = return_gpt_response(**prompt, response_format=PYTHON_CODE_FORMAT, on_token=partial(self._write_chunk, response_file))
+        self._store_function_code(response)
+
+    async def async_generate_script(self, previous_code=None, test_output=None):
+        prompt = self._generation_prompt(previous_code, test_output)
+        with self._response_file() as response_file:
+            response = await async_return_gpt_response(**prompt, response_format=PYTHON_CODE_FORMAT, on_token=partial(self._write_chunk, response_file))
+        self._store_function_code(response)
+
+    def generate_candidates(self, count, previous_code=None, test_output=None):
+        # one completion with n choices, so the candidates differ even when the prompt is cached
+        prompt = self._generation_prompt(previous_code, test_output)
+        responses = return_gpt_response(**prompt, response_format=PYTHON_CODE_FORMAT, n=count)
+        return self._parse_candidates(responses or [])
+
+    async def async_generate_candidates(self, count, previous_code=None, test_output=None):
+        prompt = self._generation_prompt(previous_code, test_output)
+        responses = await async_return_gpt_response(**prompt, response_format=PYTHON_CODE_FORMAT, n=count)
+        return self._parse_candidates(responses or [])
+
+    def _repair_arguments(self):
+        if self.attempts == 0:
+            return {}
+        return {"previous_code": self.function_code, "test_output": self.test_output}
+
+    def _record_malformed_response(self, error):
+        logger.error(f"Attempt {self.attempts} returned an unusable response: {error}")
+        self.test_output = f"The response could not be used: {type(error).__name__}: {error}"
+
+    def _record_attempt(self, passed, max_attempts):
+        if passed:
+            logger.info(f"Generated script passed on attempt {self.attempts} of {max_attempts}.")
+            self.passed = True
+        else:
+            logger.info(f"Attempt {self.attempts} of {max_attempts} failed the unit tests.")
+        return passed
+
+    def _pick_candidate(self, candidates, winner, outputs):
+        # on failure the first candidate becomes the base for the next repair prompt
+        index = 0 if winner is None else winner
+        self.function_code = candidates[index]
+        self.test_output = outputs[index]
+        if winner is not None:
+            logger.info(f"Candidate {winner + 1} of {len(candidates)} passed all unit tests.")
+            self._write_candidate(self.function_code)
+        return winner is not None
+
+    def _run_attempt(self, candidates, repair_arguments):
+        try:
+            with instrument_stage("script_generation"):
+                if candidates > 1:
+                    scripts = self.generate_candidates(candidates, **repair_arguments)
+                else:
+                    self.generate_script(**repair_arguments)
+        except (ValueError, KeyError, TypeError) as e:
+            self._record_malformed_response(e)
+            return False
+        with instrument_stage("test_run"):
+            if candidates > 1:
+                winner, outputs = self.test_candidates(scripts)
+                return self._pick_candidate(scripts, winner, outputs)
+            return self.test_generated_script(self.function_code)
 
-    def test_generated_script(self, script):
-        script_path = os.path.join(UNIQUE_FOLDER, "generated_script.py")
+    async def _async_run_attempt(self, candidates, repair_arguments):
+        try:
+            with instrument_stage("script_generation"):
+                if candidates > 1:
+                    scripts = await self.async_generate_candidates(candidates, **repair_arguments)
+                else:
+                    await self.async_generate_script(**repair_arguments)
+        except (ValueError, KeyError, TypeError) as e:
+            self._record_malformed_response(e)
+            return False
+        with instrument_stage("test_run"):
+            if candidates > 1:
+                winner, outputs = await self.async_test_candidates(scripts)
+                return self._pick_candidate(scripts, winner, outputs)
+            return await self.async_test_generated_script(self.function_code)
+
+    def _reuse_example(self, example, passed):
+        if passed:
+            logger.info(f"The script from {example['output_folder']} (similarity {example['score']}) passes the unit tests as it is")
+            self.passed = True
+            self.reused_from = example["output_folder"]
+            # the example becomes this job's script: saved, stored and served like a generated one
+            self.function_code = example["script"]
+        return passed
+
+    def _reset_after_examples(self):
+        # a failed example is not this job's attempt, so it must not become the base of a repair prompt
+        self.function_code = ""
+        self.test_output = ""
+        self.test_results = []
+
+    def try_examples(self):
+        # a similar specification's script costs one local test run to check, against
+        # one or more LLM calls to generate
+        for example in self.examples:
+            with instrument_stage("test_run"):
+                if self._reuse_example(example, self.test_generated_script(example["script"])):
+                    return True
+        self._reset_after_examples()
+        return False
+
+    async def async_try_examples(self):
+        for example in self.examples:
+            with instrument_stage("test_run"):
+                if self._reuse_example(example, await self.async_test_generated_script(example["script"])):
+                    return True
+        self._reset_after_examples()
+        return False
+
+    def generate_passing_script(self, max_attempts=DEFAULT_MAX_ATTEMPTS, candidates=DEFAULT_CANDIDATES):
+        # Regenerate the script with the previous failure as feedback until the tests
+        # pass or the attempt budget is spent. Schemas and tests are reused as they are.
+        if self.attempts == 0 and self.try_examples():
+            return True
+        while self.attempts < max_attempts:
+            check_cancelled()
+            repair_arguments = self._repair_arguments()
+            self.attempts += 1
+            if self._record_attempt(self._run_attempt(candidates, repair_arguments), max_attempts):
+                return True
+        return False
+
+    async def async_generate_passing_script(self, max_attempts=DEFAULT_MAX_ATTEMPTS, candidates=DEFAULT_CANDIDATES):
+        if self.attempts == 0 and await self.async_try_examples():
+            return True
+        while self.attempts < max_attempts:
+            check_cancelled()
+            repair_arguments = self._repair_arguments()
+            self.attempts += 1
+            if self._record_attempt(await self._async_run_attempt(candidates, repair_arguments), max_attempts):
+                return True
+        return False
+
+    def _write_candidate(self, script, folder=None):
+        # candidates tested side by side each get a sandbox folder with their own copy of the tests;
+        # the run folder gets one too, so the script is always tested against self.unit_tests
+        folder = folder or self.output_folder
+        create_directory(folder)
+        with open(os.path.join(folder, "test_script.py"), "w") as file:
+            file.write(self.unit_tests)
+        script_path = os.path.join(folder, "generated_script.py")
         with open(script_path, "w") as file:
             file.write(script)
-        result = subprocess.run(
-            ["python", os.path.join(UNIQUE_FOLDER, "test_script.py")], capture_output=True, text=True
-        )
-        if result.returncode == 0:
+        install_runtime(folder)
+        return os.path.join(folder, "test_script.py")
+
+    def _candidate_folder(self, index):
+        return os.path.join(self.output_folder, CANDIDATES_FOLDER, f"attempt_{self.attempts}_candidate_{index + 1}")
+
+    def _report_test_result(self, returncode, stderr, test_results=()):
+        self.test_output = stderr
+        self.test_results = list(test_results)
+        if returncode == 0:
             logger.info("Generated script passes all unit tests.")
             return True
         else:
-            logger.error(f"Generated script failed some tests: {result.stderr}")
+            log_payload("Generated script failed some tests", stderr, level=logging.ERROR)
             return False
 
+    def _report_runner_result(self, result):
+        return self._report_test_result(0 if result["passed"] else 1, result["output"], result["tests"])
+
+    def _preflight(self, script, folder):
+        # static checks against the tests: a script that does not parse, imports a module that
+        # is not installed or lacks a tested name is rejected without starting a test process
+        with instrument_stage("preflight"):
+            diagnostics = check_script(script, self.unit_tests, folder)
+        if not diagnostics:
+            return ""
+        rejection = "Static checks found these problems before the tests were run:\n" + "\n".join(diagnostics)
+        log_payload("Generated script rejected before testing", rejection, level=logging.ERROR)
+        return rejection
+
+    def _report_rejection(self, rejection):
+        self.test_output = rejection
+        self.test_results = []
+        return False
+
+    def test_generated_script(self, script):
+        test_path = self._write_candidate(script)
+        rejection = self._preflight(script, self.output_folder)
+        if rejection:
+            return self._report_rejection(rejection)
+        if test_runner is not None:
+            return self._report_runner_result(test_runner.run(os.path.dirname(test_path)))
+        result = subprocess.run(
+            [sys.executable, test_path], capture_output=True, text=True
+        )
+        return self._report_test_result(result.returncode, result.stderr)
+
+    async def async_test_generated_script(self, script):
+        test_path = self._write_candidate(script)
+        rejection = self._preflight(script, self.output_folder)
+        if rejection:
+            return self._report_rejection(rejection)
+        if test_runner is not None:
+            result = await asyncio.to_thread(test_runner.run, os.path.dirname(test_path))
+            return self._report_runner_result(result)
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, test_path, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+        return self._report_test_result(process.returncode, stderr.decode(errors="replace"))
+
+    def _prepare_candidates(self, candidates):
+        # Writes every candidate to its sandbox folder and runs the static checks. Returns the
+        # outputs, which start as the check rejections, and the folders of the candidates
+        # without one, by index: only those are run.
+        folders = [
+            os.path.dirname(self._write_candidate(script, self._candidate_folder(index))) for index, script in enumerate(candidates)
+        ]
+        outputs = [self._preflight(script, folder) for script, folder in zip(candidates, folders)]
+        runnable = {index: folder for index, folder in enumerate(folders) if not outputs[index]}
+        return outputs, runnable
+
+    def _test_candidates_with_runner(self, folders, outputs):
+        # folders maps the index of every candidate to run to its sandbox folder. Once one
+        # passes, the cancelled event stops the runs still in progress (their workers are
+        # killed and restarted on next use) and this returns without waiting for them.
+        cancelled = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=len(folders))
+        try:
+            futures = {executor.submit(test_runner.run, folder, cancelled): index for index, folder in folders.items()}
+            for future in as_completed(futures):
+                index = futures[future]
+                result = future.result()
+                outputs[index] = result["output"]
+                if result["passed"]:
+                    self.test_results = result["tests"]
+                    return index, outputs
+        finally:
+            cancelled.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+        return None, outputs
+
+    def test_candidates(self, candidates):
+        # Test every candidate in parallel; the first one to pass wins and the
+        # remaining test runs are killed. Returns the winner's index (or None) and the outputs.
+        outputs, runnable = self._prepare_candidates(candidates)
+        if not runnable:
+            return None, outputs
+        if test_runner is not None:
+            return self._test_candidates_with_runner(runnable, outputs)
+        processes = {}
+        for index, folder in runnable.items():
+            processes[index] = subprocess.Popen(
+                [sys.executable, os.path.join(folder, "test_script.py")], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+            )
+        winner = None
+        with ThreadPoolExecutor(max_workers=len(processes)) as executor:
+            futures = {executor.submit(process.communicate): index for index, process in processes.items()}
+            try:
+                for future in as_completed(futures):
+                    index = futures[future]
+                    outputs[index] = future.result()[1]
+                    if processes[index].returncode == 0:
+                        winner = index
+                        break
+            finally:
+                for process in processes.values():
+                    if process.poll() is None:
+                        process.kill()
+        return winner, outputs
+
+    async def async_test_candidates(self, candidates):
+        outputs, runnable = self._prepare_candidates(candidates)
+        if not runnable:
+            return None, outputs
+        if test_runner is not None:
+            return await asyncio.to_thread(self._test_candidates_with_runner, runnable, outputs)
+        processes = {}
+        for index, folder in runnable.items():
+            processes[index] = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.join(folder, "test_script.py"), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+
+        async def run(index):
+            _, stderr = await processes[index].communicate()
+            return index, stderr.decode(errors="replace")
+
+        winner = None
+        tasks = [asyncio.ensure_future(run(index)) for index in processes]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                index, outputs[index] = await next_result
+                if processes[index].returncode == 0:
+                    winner = index
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+            for process in processes.values():
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+        return winner, outputs
+
     def save_generated_script(self):
-        filename = os.path.join(UNIQUE_FOLDER, "final_script.py")
+        filename = os.path.join(self.output_folder, "final_script.py")
         with open(filename, "w") as file:
             file.write(self.function_code)
+        install_runtime(self.output_folder)
         logger.info(f"Saved generated script to {filename}")
 
 
-def workflow(requirements):
-    spec_gatherer = SpecGathering()
-    if requirements:
-        spec_gatherer.specifications = requirements
-    else:
-        spec_gatherer.gather_requirements()
-    
-    spec_gatherer.generate_schema(schema_type="input")
-    spec_gatherer.generate_schema(schema_type="output")
+def stage_inputs(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class Checkpoint:
+    # Records in checkpoint.json, for every finished stage, a hash of what it was computed
+    # from and the files it wrote. A resumed run skips a stage when its inputs hash
+    # matches and its files are still there, so a changed specification or an edited
+    # test file re-runs exactly the stages downstream of the change.
+    def __init__(self, folder, resume=False):
+        self.folder = folder
+        self.path = os.path.join(folder, CHECKPOINT_FILE)
+        self.specifications = None
+        self.stages = {}
+        # folders from before checkpoints existed: files already on disk are trusted as they are
+        self.adopt_files = False
+        self._lock = threading.Lock()
+        if resume:
+            if os.path.exists(self.path):
+                with open(self.path, "r") as file:
+                    checkpoint = json.load(file)
+                self.specifications = checkpoint.get("specifications")
+                self.stages = checkpoint.get("stages", {})
+            else:
+                self.adopt_files = True
+
+    def _save(self):
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump({"specifications": self.specifications, "stages": self.stages}, file, indent=4)
+        os.replace(temporary_path, self.path)
+
+    def set_specifications(self, specifications):
+        with self._lock:
+            self.specifications = specifications
+            self._save()
+
+    def fresh(self, name, inputs, files):
+        with self._lock:
+            entry = self.stages.get(name)
+            files_present = all(os.path.exists(os.path.join(self.folder, file)) for file in files)
+            if entry is None and self.adopt_files and files_present:
+                logger.info(f"Adopting the existing {', '.join(files)} for stage {name}")
+                return True
+            return entry is not None and entry["inputs"] == inputs and files_present
+
+    def mark(self, name, inputs, files):
+        with self._lock:
+            self.stages[name] = {"inputs": inputs, "files": list(files)}
+            self._save()
+
+
+def schema_inputs(spec_gatherer, schema_type):
+    return stage_inputs(f"{schema_type}_schema", spec_gatherer.specifications)
+
+
+def unit_test_inputs(spec_gatherer):
+    return stage_inputs("unit_tests", spec_gatherer.specifications, spec_gatherer.input_schema, spec_gatherer.output_schema)
+
+
+def script_inputs(spec_gatherer, unit_tests):
+    return stage_inputs("script", spec_gatherer.specifications, spec_gatherer.input_schema, spec_gatherer.output_schema, unit_tests)
+
+
+def restore_schema(checkpoint, spec_gatherer, schema_type):
+    file_name = f"{schema_type}_schema.json"
+    if not checkpoint.fresh(f"{schema_type}_schema", schema_inputs(spec_gatherer, schema_type), [file_name]):
+        return False
+    with open(os.path.join(checkpoint.folder, file_name), "r") as file:
+        setattr(spec_gatherer, f"{schema_type}_schema", json.load(file))
+    logger.info(f"Resumed the {schema_type} schema from {file_name}")
+    return True
+
+
+def restore_unit_tests(checkpoint, spec_gatherer, test_generator):
+    if not checkpoint.fresh("unit_tests", unit_test_inputs(spec_gatherer), ["test_script.py"]):
+        return False
+    with open(os.path.join(checkpoint.folder, "test_script.py"), "r") as file:
+        test_generator.unit_tests = file.read()
+    logger.info("Resumed the unit tests from test_script.py")
+    return True
+
+
+def restore_script(checkpoint, spec_gatherer, script_generator):
+    if not checkpoint.fresh("script", script_inputs(spec_gatherer, script_generator.unit_tests), ["final_script.py"]):
+        return False
+    with open(os.path.join(checkpoint.folder, "final_script.py"), "r") as file:
+        script_generator.function_code = file.read()
+    script_generator.passed = True
+    script_generator.restored = True
+    install_runtime(checkpoint.folder)
+    logger.info("Resumed the passing script from final_script.py")
+    return True
+
+
+def save_schemas(spec_gatherer, checkpoint):
     spec_gatherer.save_schema(spec_gatherer.input_schema, schema_type="input")
     spec_gatherer.save_schema(spec_gatherer.output_schema, schema_type="output")
-    
-    test_generator = UnitTestGenerator(
-        spec_gatherer.input_schema, spec_gatherer.output_schema
-    )
-    test_generator.generate_unit_tests(spec_gatherer.specifications)
+    for schema_type in ("input", "output"):
+        checkpoint.mark(f"{schema_type}_schema", schema_inputs(spec_gatherer, schema_type), [f"{schema_type}_schema.json"])
+
+
+def save_unit_tests(checkpoint, spec_gatherer, test_generator):
     test_generator.save_unit_tests()
-    
-    script_generator = ScriptGenerator(
-        specifications=spec_gatherer.specifications,
-        input_schema=spec_gatherer.input_schema,
-        output_schema=spec_gatherer.output_schema,
-        unit_tests=test_generator.unit_tests,
-    )
-    script_generator.generate_script()
-    if script_generator.test_generated_script(script_generator.function_code):
+    checkpoint.mark("unit_tests", unit_test_inputs(spec_gatherer), ["test_script.py"])
+
+
+def resume_specifications(requirements, checkpoint):
+    # new requirements win over the checkpointed ones and invalidate every stage
+    if requirements:
+        return requirements
+    if checkpoint.specifications:
+        logger.info(f"Resuming with the specification from {checkpoint.path}")
+        return checkpoint.specifications
+    return None
+
+
+def context_token_savings(spec_gatherer, script_attempts):
+    report = spec_gatherer.token_report()
+    saved = report["saved_per_prompt"]
+    return {
+        "requirements": report["saved_during_gathering"],
+        "input_schema": saved,
+        "output_schema": saved,
+        "unit_tests": saved,
+        "script": saved * script_attempts,
+    }
+
+
+@contextlib.contextmanager
+def collect_run_metrics(output_folder):
+    # every job gets a run_report.json, including the ones that fail part-way
+    metrics = RunMetrics(os.path.basename(os.path.normpath(output_folder)))
+    token = current_run_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        current_run_metrics.reset(token)
+        path = metrics.save(output_folder)
+        totals = metrics.report()["totals"]
+        logger.info(
+            f"Run report saved to {path}: {totals['llm_calls']} LLM calls, "
+            f"{totals['prompt_tokens'] + totals['completion_tokens']} tokens, ${totals['cost_usd']:.4f} estimated"
+        )
+
+
+def write_metadata(output_folder, metadata):
+    with open(os.path.join(output_folder, METADATA_FILE), "w") as file:
+        json.dump(metadata, file, indent=4)
+
+
+def reuse_stored_script(specifications, output_folder):
+    # an equivalent specification that already produced a passing script is not generated again
+    if artifact_store.mode != "use":
+        return None
+    stored = artifact_store.find_passing(specifications)
+    if stored is None:
+        return None
+    files = {
+        "input_schema.json": stored["input_schema"],
+        "output_schema.json": stored["output_schema"],
+        "test_script.py": stored["unit_tests"],
+        "final_script.py": stored["final_script"],
+    }
+    for name, content in files.items():
+        with open(os.path.join(output_folder, name), "w") as file:
+            file.write(content or "")
+    install_runtime(output_folder)
+    write_metadata(output_folder, {
+        "spec_hash": stored["spec_hash"],
+        "passed": True,
+        "attempts": 0,
+        "reused_from": stored["output_folder"],
+    })
+    artifact_store.reused += 1
+    logger.info(f"Reused the passing script from {stored['output_folder']} for an equivalent specification")
+    return {
+        "passed": True,
+        "attempts": 0,
+        "output_folder": output_folder,
+        "stage_seconds": {},
+        "context_tokens_saved": {},
+        "reused_from": stored["output_folder"],
+    }
+
+
+def find_similar_scripts(specifications):
+    # only when stored scripts may be reused at all; --regenerate must not get its own old script back
+    if artifact_store.mode != "use" or not spec_index.k:
+        return []
+    # the index only holds specifications and run ids; scripts are read for the hits alone
+    with _spec_index_lock:
+        if not spec_index.loaded:
+            for run in artifact_store.passing_specifications():
+                spec_index.add(run["specification"], run, key=run["spec_hash"])
+            spec_index.loaded = True
+    hits = spec_index.search(specifications)
+    scripts = artifact_store.final_scripts(hit["run_id"] for hit in hits)
+    examples = [{**hit, "script": scripts[hit["run_id"]]} for hit in hits if scripts.get(hit["run_id"])]
+    for example in examples:
+        logger.info(f"Similar passing script in {example['output_folder']} (similarity {example['score']})")
+    return examples
+
+
+def record_artifacts(spec_gatherer, unit_tests, script_generator, result):
+    metrics = current_run_metrics.get()
+    report = metrics.report() if metrics is not None else {"totals": {}, "llm_calls": []}
+    totals = report["totals"]
+    models = sorted({call["model"] for call in report["llm_calls"]})
+    metadata = {
+        "spec_hash": spec_hash(spec_gatherer.specifications),
+        "passed": result["passed"],
+        "attempts": result["attempts"],
+        "model": ",".join(models) or None,
+        "duration_seconds": totals.get("wall_seconds"),
+        "prompt_tokens": totals.get("prompt_tokens"),
+        "completion_tokens": totals.get("completion_tokens"),
+        "cost_usd": totals.get("cost_usd"),
+        "stage_seconds": result["stage_seconds"],
+    }
+    if script_generator.reused_from:
+        metadata["reused_from"] = script_generator.reused_from
+    if "batch_benchmark" in result:
+        metadata["batch_benchmark"] = result["batch_benchmark"]
+    write_metadata(result["output_folder"], metadata)
+    if artifact_store.mode == "bypass":
+        return
+    artifacts = {
+        "input_schema": json.dumps(spec_gatherer.input_schema, indent=4),
+        "output_schema": json.dumps(spec_gatherer.output_schema, indent=4),
+        "unit_tests": unit_tests,
+        "final_script": script_generator.function_code,
+    }
+    fields = {key: value for key, value in metadata.items() if key not in ("spec_hash", "passed", "attempts", "reused_from", "batch_benchmark")}
+    run_id = artifact_store.record(spec_gatherer.specifications, result["output_folder"], result["passed"], result["attempts"], artifacts, **fields)
+    if result["passed"] and spec_index.loaded:
+        spec_index.add(spec_gatherer.specifications, {
+            "run_id": run_id,
+            "spec_hash": metadata["spec_hash"],
+            "specification": spec_gatherer.specifications,
+            "output_folder": result["output_folder"],
+        }, key=metadata["spec_hash"])
+
+
+def finish_workflow(scheduler, output_folder, spec_gatherer, checkpoint):
+    script_generator = scheduler.results["script"]
+    tokens_saved = context_token_savings(spec_gatherer, script_generator.attempts)
+    if any(tokens_saved.values()):
+        logger.info(f"Tokens saved by the bounded requirement context per stage: {json.dumps(tokens_saved)}")
+    passed = script_generator.passed
+    batch_benchmark = None
+    if passed:
         script_generator.save_generated_script()
+        checkpoint.mark("script", script_inputs(spec_gatherer, script_generator.unit_tests), ["final_script.py"])
+        batch_benchmark = benchmark_batch(output_folder, script_generator.function_code)
     else:
-        logger.error("The generated script did not pass all the unit tests.")
+        logger.error(f"The generated script did not pass all the unit tests after {script_generator.attempts} attempts.")
+    result = {
+        "passed": passed,
+        "attempts": script_generator.attempts,
+        "output_folder": output_folder,
+        "stage_seconds": scheduler.timings,
+        "context_tokens_saved": tokens_saved,
+    }
+    if script_generator.reused_from:
+        result["reused_from"] = script_generator.reused_from
+    if batch_benchmark is not None:
+        result["batch_benchmark"] = batch_benchmark
+    if not script_generator.restored:
+        record_artifacts(spec_gatherer, scheduler.results["unit_tests"].unit_tests, script_generator, result)
+    return result
+
+
+class WorkflowRun:
+    # Everything a workflow does that is the same on threads and on an event loop: the run
+    # folder and checkpoint, the specifications, reuse of a stored script, the similar-script
+    # lookup, the stage graph and the final result. workflow and async_workflow only differ in
+    # how they gather requirements and call the stage callables below.
+    def __init__(self, output_folder=None, max_attempts=DEFAULT_MAX_ATTEMPTS, candidates=DEFAULT_CANDIDATES, resume=False):
+        # with resume, output_folder is an earlier run and only its missing or outdated stages run
+        self.output_folder = output_folder or new_run_folder()
+        create_directory(self.output_folder)
+        self.max_attempts = max_attempts
+        self.candidates = candidates
+        self.resume = resume
+        self.checkpoint = Checkpoint(self.output_folder, resume=resume)
+        self.spec_gatherer = None
+        self.examples = []
+        self.scheduler = StageScheduler()
+
+    def needs_requirements(self, requirements):
+        # False when the specification is given or checkpointed, True when it must be gathered
+        self.spec_gatherer = SpecGathering(output_folder=self.output_folder)
+        requirements = resume_specifications(requirements, self.checkpoint)
+        if requirements:
+            self.spec_gatherer.specifications = requirements
+        return not requirements
+
+    def start(self):
+        # the result of a stored passing script for an equivalent specification, if there is one
+        self.checkpoint.set_specifications(self.spec_gatherer.specifications)
+        # a resumed folder keeps its own artifacts rather than being overwritten by a stored run
+        reused = None if self.resume else reuse_stored_script(self.spec_gatherer.specifications, self.output_folder)
+        if reused is None:
+            self.examples = find_similar_scripts(self.spec_gatherer.specifications)
+        return reused
+
+    def add_stages(self, use_async=False):
+        if use_async:
+            generate_schema, generate_unit_tests, generate_script = self.async_generate_schema, self.async_generate_unit_tests, self.async_generate_script
+        else:
+            generate_schema, generate_unit_tests, generate_script = self.generate_schema, self.generate_unit_tests, self.generate_script
+        # both schemas only depend on the specifications, so they are generated concurrently
+        self.scheduler.add_stage("input_schema", partial(generate_schema, "input"))
+        self.scheduler.add_stage("output_schema", partial(generate_schema, "output"))
+        self.scheduler.add_stage(
+            "save_schemas", partial(save_schemas, self.spec_gatherer, self.checkpoint), depends_on=("input_schema", "output_schema")
+        )
+        self.scheduler.add_stage("unit_tests", generate_unit_tests, depends_on=("input_schema", "output_schema"))
+        self.scheduler.add_stage("script", generate_script, depends_on=("unit_tests",))
+
+    def _test_generator(self):
+        return UnitTestGenerator(self.spec_gatherer.input_schema, self.spec_gatherer.output_schema, output_folder=self.output_folder)
+
+    def _script_generator(self):
+        return ScriptGenerator(
+            specifications=self.spec_gatherer.specifications,
+            input_schema=self.spec_gatherer.input_schema,
+            output_schema=self.spec_gatherer.output_schema,
+            unit_tests=self.scheduler.results["unit_tests"].unit_tests,
+            output_folder=self.output_folder,
+            examples=self.examples,
+        )
+
+    def generate_schema(self, schema_type):
+        if not restore_schema(self.checkpoint, self.spec_gatherer, schema_type):
+            self.spec_gatherer.generate_schema(schema_type=schema_type)
+
+    async def async_generate_schema(self, schema_type):
+        if not restore_schema(self.checkpoint, self.spec_gatherer, schema_type):
+            await self.spec_gatherer.async_generate_schema(schema_type=schema_type)
+
+    def generate_unit_tests(self):
+        test_generator = self._test_generator()
+        if not restore_unit_tests(self.checkpoint, self.spec_gatherer, test_generator):
+            test_generator.generate_unit_tests(self.spec_gatherer.specifications)
+            save_unit_tests(self.checkpoint, self.spec_gatherer, test_generator)
+        return test_generator
+
+    async def async_generate_unit_tests(self):
+        test_generator = self._test_generator()
+        if not restore_unit_tests(self.checkpoint, self.spec_gatherer, test_generator):
+            await test_generator.async_generate_unit_tests(self.spec_gatherer.specifications)
+            save_unit_tests(self.checkpoint, self.spec_gatherer, test_generator)
+        return test_generator
+
+    def generate_script(self):
+        script_generator = self._script_generator()
+        if not restore_script(self.checkpoint, self.spec_gatherer, script_generator):
+            script_generator.generate_passing_script(max_attempts=self.max_attempts, candidates=self.candidates)
+        return script_generator
+
+    async def async_generate_script(self):
+        script_generator = self._script_generator()
+        if not restore_script(self.checkpoint, self.spec_gatherer, script_generator):
+            await script_generator.async_generate_passing_script(max_attempts=self.max_attempts, candidates=self.candidates)
+        return script_generator
+
+    def finish(self):
+        return finish_workflow(self.scheduler, self.output_folder, self.spec_gatherer, self.checkpoint)
+
+
+def workflow(requirements, output_folder=None, max_attempts=DEFAULT_MAX_ATTEMPTS, candidates=DEFAULT_CANDIDATES, resume=False):
+    run = WorkflowRun(output_folder, max_attempts, candidates, resume)
+    with collect_run_metrics(run.output_folder):
+        if run.needs_requirements(requirements):
+            with instrument_stage("requirements"):
+                run.spec_gatherer.gather_requirements()
+        reused = run.start()
+        if reused is not None:
+            return reused
+        run.add_stages()
+        run.scheduler.run()
+        return run.finish()
+
+
+async def async_workflow(requirements, output_folder=None, max_attempts=DEFAULT_MAX_ATTEMPTS, candidates=DEFAULT_CANDIDATES, resume=False):
+    run = WorkflowRun(output_folder, max_attempts, candidates, resume)
+    with collect_run_metrics(run.output_folder):
+        if run.needs_requirements(requirements):
+            with instrument_stage("requirements"):
+                await run.spec_gatherer.async_gather_requirements()
+        # a thread, as the stored-script lookups read SQLite and may load the similarity index
+        reused = await asyncio.to_thread(run.start)
+        if reused is not None:
+            return reused
+        run.add_stages(use_async=True)
+        await run.scheduler.async_run()
+        # a thread, so the batch benchmark's subprocess does not hold up the event loop
+        return await asyncio.to_thread(run.finish)
+
+
+async def async_run_workflow(requirements, output_folder=None, max_attempts=DEFAULT_MAX_ATTEMPTS, candidates=DEFAULT_CANDIDATES, resume=False):
+    # a single job on an event loop of its own, like async_run_batch: the pooled client is
+    # closed before the loop that opened it
+    try:
+        return await async_workflow(requirements, output_folder, max_attempts, candidates, resume)
+    finally:
+        await close_async_client()
+
+
+def read_batch_requests(path):
+    jobs = []
+    with open(path, "r") as file:
+        for line_number, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            request = json.loads(line)
+            job_id = str(request.get("request_id") or f"job-{line_number:04d}")
+            if "requirements" in request:
+                requirements = request["requirements"]
+            else:
+                requirements = "\n\n".join(
+                    part for part in (request.get("title", ""), request.get("body", "")) if part
+                )
+            if not requirements:
+                raise ValueError(f"Batch request on line {line_number} has no requirements.")
+            jobs.append({"job_id": job_id, "requirements": requirements})
+    # every job needs a folder of its own, so ids that are repeated or only differ in the
+    # characters safe_job_id replaces get a numbered suffix
+    seen = set()
+    for job in jobs:
+        unique_id = base_id = safe_job_id(job["job_id"])
+        for number in itertools.count(2):
+            if unique_id not in seen:
+                break
+            unique_id = f"{base_id}-{number}"
+        if unique_id != job["job_id"]:
+            logger.warning(f"Batch request {job['job_id']!r} runs as job {unique_id} so it gets its own folder")
+            job["job_id"] = unique_id
+        seen.add(unique_id)
+    return jobs
+
+
+def safe_job_id(job_id):
+    # letters, digits, "_" and "-" only, so an id can never be "." or ".." or contain a separator
+    return re.sub(r"[^A-Za-z0-9_-]", "_", job_id)
+
+
+def batch_job_folder(job, batch_folder):
+    # every job writes into its own sub-folder so concurrent runs never share files
+    return os.path.join(batch_folder, safe_job_id(job["job_id"]))
+
+
+def summarize_batch_job(job, output_folder, started, result=None, error=None):
+    summary = {"job_id": job["job_id"], "output_folder": output_folder, "attempts": 0}
+    if error is not None:
+        summary["status"] = "error"
+        summary["error"] = f"{type(error).__name__}: {error}"
+    else:
+        summary["status"] = "passed" if result["passed"] else "failed"
+        summary["attempts"] = result["attempts"]
+        summary["stage_seconds"] = result["stage_seconds"]
+        if "reused_from" in result:
+            summary["reused_from"] = result["reused_from"]
+    run_report = os.path.join(output_folder, RUN_REPORT_FILE)
+    if os.path.exists(run_report):
+        summary["run_report"] = run_report
+    finished = time.time()
+    summary["started_at"] = started
+    summary["finished_at"] = finished
+    summary["duration_seconds"] = round(finished - started, 3)
+    logger.info(f"Batch job {job['job_id']} finished with status {summary['status']} in {summary['duration_seconds']}s")
+    return summary
+
+
+@contextlib.contextmanager
+def batch_job_run(job, batch_folder):
+    # What every batch job does around its workflow: its own folder and log, and a summary of
+    # the result the caller stores in outcome["result"], or of the error it raised.
+    request_priority.set(PRIORITY_BATCH)
+    output_folder = batch_job_folder(job, batch_folder)
+    outcome = {"output_folder": output_folder}
+    started = time.time()
+    logger.info(f"Batch job {job['job_id']} started in {output_folder}")
+    try:
+        with job_logging(output_folder):
+            yield outcome
+    except Exception as e:
+        logger.error(f"Batch job {job['job_id']} raised an error", exc_info=True)
+        outcome["summary"] = summarize_batch_job(job, output_folder, started, error=e)
+    else:
+        outcome["summary"] = summarize_batch_job(job, output_folder, started, result=outcome["result"])
+
+
+def run_batch_job(job, batch_folder, max_attempts=DEFAULT_MAX_ATTEMPTS, candidates=DEFAULT_CANDIDATES):
+    with batch_job_run(job, batch_folder) as outcome:
+        outcome["result"] = workflow(job["requirements"], output_folder=outcome["output_folder"], max_attempts=max_attempts, candidates=candidates)
+    return outcome["summary"]
+
+
+async def async_run_batch_job(job, batch_folder, semaphore, max_attempts=DEFAULT_MAX_ATTEMPTS, candidates=DEFAULT_CANDIDATES):
+    async with semaphore:
+        with batch_job_run(job, batch_folder) as outcome:
+            outcome["result"] = await async_workflow(job["requirements"], output_folder=outcome["output_folder"], max_attempts=max_attempts, candidates=candidates)
+        return outcome["summary"]
+
+
+def save_batch_report(summaries, batch_folder):
+    reports = []
+    for summary in summaries:
+        if "run_report" in summary:
+            with open(summary["run_report"], "r") as file:
+                reports.append(json.load(file))
+    report = aggregate_run_reports(reports)
+    report["passed"] = sum(1 for summary in summaries if summary["status"] == "passed")
+    path = os.path.join(batch_folder, BATCH_REPORT_FILE)
+    with open(path, "w") as file:
+        json.dump(report, file, indent=4)
+    return path
+
+
+def report_batch(summaries, summary_path):
+    passed = sum(1 for summary in summaries if summary["status"] == "passed")
+    report_path = save_batch_report(summaries, os.path.dirname(summary_path))
+    logger.info(f"Batch finished: {passed}/{len(summaries)} jobs passed. Summary written to {summary_path}, latency report to {report_path}")
+    print(f"{passed}/{len(summaries)} jobs passed. Summary written to {summary_path}")
+
+
+class BatchRun:
+    # What run_batch and async_run_batch share: the jobs, the batch folder, a summary line
+    # written per job as soon as it finishes, and the batch report once all are done.
+    def __init__(self, path, batch_folder=None):
+        self.jobs = read_batch_requests(path)
+        self.folder = batch_folder or new_run_folder()
+        create_directory(self.folder)
+        self.summary_path = os.path.join(self.folder, BATCH_SUMMARY_FILE)
+        self.summaries = []
+        self._summary_file = None
+
+    def __enter__(self):
+        self._summary_file = open(self.summary_path, "w")
+        return self
+
+    def add(self, summary):
+        self.summaries.append(summary)
+        self._summary_file.write(json.dumps(summary) + "\n")
+        self._summary_file.flush()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._summary_file.close()
+        if exc_type is None:
+            report_batch(self.summaries, self.summary_path)
+
+
+def run_batch(path, workers=DEFAULT_BATCH_WORKERS, batch_folder=None, max_attempts=DEFAULT_MAX_ATTEMPTS, candidates=DEFAULT_CANDIDATES):
+    batch = BatchRun(path, batch_folder)
+    logger.info(f"Running {len(batch.jobs)} batch jobs from {path} with {workers} workers")
+    with ThreadPoolExecutor(max_workers=workers) as executor, batch:
+        futures = [executor.submit(run_batch_job, job, batch.folder, max_attempts, candidates) for job in batch.jobs]
+        for future in as_completed(futures):
+            batch.add(future.result())
+    return batch.summaries
+
+
+async def async_run_batch(path, workers=DEFAULT_BATCH_WORKERS, batch_folder=None, max_attempts=DEFAULT_MAX_ATTEMPTS, candidates=DEFAULT_CANDIDATES):
+    # all jobs share one event loop and one pooled client; `workers` bounds how many are in flight
+    batch = BatchRun(path, batch_folder)
+    logger.info(f"Running {len(batch.jobs)} batch jobs from {path} on one event loop with {workers} in flight")
+    semaphore = asyncio.Semaphore(workers)
+    try:
+        with batch:
+            tasks = [async_run_batch_job(job, batch.folder, semaphore, max_attempts, candidates) for job in batch.jobs]
+            for next_summary in asyncio.as_completed(tasks):
+                batch.add(await next_summary)
+    finally:
+        await close_async_client()
+    return batch.summaries
 
 
 def main():
+    global batch_benchmark_records
     parser = argparse.ArgumentParser(
         description="Generate Python functions based on user requirements."
     )
@@ -503,8 +2706,155 @@ def main():
         "--file",
         help="Path to a text file containing the high-level user requirements.",
     )
+    group.add_argument(
+        "--batch",
+        help="Path to a JSONL file with one generation request per line (request_id, title, body or requirements).",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=DEFAULT_BATCH_WORKERS,
+        help="Number of batch jobs to run concurrently.",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=DEFAULT_MAX_ATTEMPTS,
+        help="How many times to generate the script, feeding test failures back, before giving up.",
+    )
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=DEFAULT_CANDIDATES,
+        help="Generate this many candidate scripts per attempt and keep the first one that passes its tests.",
+    )
+    add_test_runner_arguments(parser)
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        help="Requests per minute allowed per model (defaults to the built-in table).",
+    )
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        help="Tokens per minute allowed per model (defaults to the built-in table).",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Run on a single asyncio event loop with a shared, pooled LLM client instead of threads.",
+    )
+    cache_group = parser.add_mutually_exclusive_group(required=False)
+    cache_group.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Bypass the LLM response cache entirely.",
+    )
+    cache_group.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="Ignore cached LLM responses but store the fresh ones.",
+    )
+    store_group = parser.add_mutually_exclusive_group(required=False)
+    store_group.add_argument(
+        "--no-store",
+        action="store_true",
+        help="Neither reuse nor record scripts in the artifact store.",
+    )
+    store_group.add_argument(
+        "--regenerate",
+        action="store_true",
+        help="Generate a new script even if an equivalent specification already has a passing one.",
+    )
+    parser.add_argument(
+        "--log-format",
+        choices=["text", "compact"],
+        default="text",
+        help="text: function_generation.log with every prompt and response inline. compact: JSON lines with prompts and responses stored once by content hash.",
+    )
+    parser.add_argument(
+        "--log-max-mb",
+        type=float,
+        default=0,
+        help="Rotate a log file once it reaches this many megabytes (0 never rotates).",
+    )
+    parser.add_argument(
+        "--log-backups",
+        type=int,
+        default=log_settings.backup_count,
+        help="Number of rotated log files to keep.",
+    )
+    parser.add_argument(
+        "--log-sample-rate",
+        type=float,
+        default=1.0,
+        help="With --log-format compact, fraction of prompts and responses stored in full (warnings and errors always are).",
+    )
+    parser.add_argument(
+        "--resume",
+        metavar="FOLDER",
+        help="Continue an earlier run in FOLDER, running only the stages whose outputs are missing or out of date.",
+    )
+    parser.add_argument(
+        "--similar",
+        type=int,
+        default=spec_index.k,
+        help="Number of passing scripts of similar past specifications to try and show as examples (0 to disable).",
+    )
+    parser.add_argument(
+        "--batch-benchmark",
+        type=int,
+        default=0,
+        metavar="RECORDS",
+        help="Time a passing script's _batch function against its per-record function on this many sampled records, e.g. 1000. "
+        "The functions are called for real, without mocks, so only use it for scripts without network, LLM or file side effects.",
+    )
     args = parser.parse_args()
+    if args.resume:
+        if args.batch:
+            parser.error("--resume cannot be combined with --batch")
+        if not os.path.isdir(args.resume):
+            parser.error(f"--resume folder {args.resume} does not exist")
+    if not 0 <= args.log_sample_rate <= 1:
+        parser.error("--log-sample-rate must be between 0 and 1")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.max_attempts < 1:
+        parser.error("--max-attempts must be at least 1")
+    if args.candidates < 1:
+        parser.error("--candidates must be at least 1")
+    check_test_runner_arguments(parser, args)
+    # only a valid command line gets a run folder and a log
+    log_settings.mode = args.log_format
+    log_settings.max_bytes = int(args.log_max_mb * 1024 * 1024)
+    log_settings.backup_count = args.log_backups
+    log_settings.sample_rate = args.log_sample_rate
+    run_folder = args.resume or new_run_folder()
+    configure_logging(run_folder)
+    if args.no_cache:
+        response_cache.mode = "bypass"
+    elif args.refresh_cache:
+        response_cache.mode = "refresh"
+    spec_index.k = args.similar
+    batch_benchmark_records = args.batch_benchmark
+    if args.no_store:
+        artifact_store.mode = "bypass"
+    elif args.regenerate:
+        artifact_store.mode = "refresh"
+    if args.rpm:
+        request_scheduler.limit_overrides["requests_per_minute"] = args.rpm
+    if args.tpm:
+        request_scheduler.limit_overrides["tokens_per_minute"] = args.tpm
+    set_test_runner(test_runner_from_arguments(args))
     try:
+        if args.batch:
+            if args.use_async:
+                asyncio.run(async_run_batch(args.batch, workers=args.workers, batch_folder=run_folder, max_attempts=args.max_attempts, candidates=args.candidates))
+            else:
+                run_batch(args.batch, workers=args.workers, batch_folder=run_folder, max_attempts=args.max_attempts, candidates=args.candidates)
+            return
         if args.file:
             with open(args.file, "r") as file:
                 requirements = file.read().strip()
@@ -512,10 +2862,22 @@ def main():
         else:
             requirements = args.requirements
             logger.info("Requirements provided as a direct string.")
-        workflow(requirements)
+        if args.use_async:
+            asyncio.run(async_run_workflow(requirements, output_folder=run_folder, max_attempts=args.max_attempts, candidates=args.candidates, resume=bool(args.resume)))
+        else:
+            workflow(requirements, output_folder=run_folder, max_attempts=args.max_attempts, candidates=args.candidates, resume=bool(args.resume))
     except Exception as e:
         logger.error("Execution failed", exc_info=True)
         raise e
+    finally:
+        set_test_runner(None)
+        request_scheduler.log_stats()
+        response_cache.log_stats()
+        evicted = response_cache.evict()
+        if evicted:
+            logger.info(f"Evicted {evicted} entries from the LLM response cache")
+        if artifact_store.reused:
+            logger.info(f"Reused {artifact_store.reused} stored scripts instead of generating them")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+
+# This file is copied next to every generated script, which imports it, so it must only
+# depend on the standard library. orjson is used for compact output when it is installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+STDIO = "-"
+# records written to a file between flushes
+WRITE_CHUNK_RECORDS = 1000
+# records handed to a script's _batch function at a time
+BATCH_CHUNK_RECORDS = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def dumps(data, pretty=False):
+    # compact by default: chained scripts read what they write, nobody needs the indentation
+    if pretty:
+        return json.dumps(data, indent=4, ensure_ascii=False)
+    if orjson is not None:
+        try:
+            return orjson.dumps(data).decode()
+        except TypeError:
+            # non-string keys, integers beyond 64 bits and the like
+            pass
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+def loads(text):
+    return orjson.loads(text) if orjson is not None else json.loads(text)
+
+
+def _open(path, mode):
+    if path is None or path == STDIO:
+        return contextlib.nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    return open(path, mode, encoding="utf-8")
+
+
+def read_json(path=STDIO):
+    with _open(path, "r") as file:
+        return loads(file.read())
+
+
+def write_json(data, path=STDIO, pretty=False):
+    with _open(path, "w") as file:
+        file.write(dumps(data, pretty))
+        file.write("\n")
+
+
+def read_records(path=STDIO):
+    # Yields the records of a JSON lines file one at a time, so a large input is never held
+    # in memory. A file holding a single JSON document, pretty-printed or not, yields that
+    # document, or its items if it is an array.
+    with _open(path, "r") as file:
+        line = file.readline()
+        while line and not line.strip():
+            line = file.readline()
+        if not line:
+            return
+        try:
+            first = loads(line)
+        except ValueError:
+            document = loads(line + file.read())
+            yield from document if isinstance(document, list) else [document]
+            return
+        yield from first if isinstance(first, list) else [first]
+        for line in file:
+            if line.strip():
+                yield loads(line)
+
+
+def write_records(records, path=STDIO):
+    # one compact JSON document per line; returns the number of records written
+    count = 0
+    with _open(path, "w") as file:
+        lines = []
+        for record in records:
+            lines.append(dumps(record))
+            count += 1
+            if len(lines) >= WRITE_CHUNK_RECORDS:
+                file.write("\n".join(lines) + "\n")
+                lines = []
+        if lines:
+            file.write("\n".join(lines) + "\n")
+        file.flush()
+    return count
+
+
+def process_records(function, records, errors=None):
+    # Yields function(record) for every record. With an errors list, a record that raises is
+    # appended to it with its error and skipped; without one the error stops the stream.
+    for record in records:
+        if errors is None:
+            yield function(record)
+            continue
+        try:
+            yield function(record)
+        except Exception as e:
+            logger.exception(f"Record failed: {e}")
+            errors.append({"input_data": record, "error_message": f"{type(e).__name__}: {e}"})
+
+
+def chunks(records, size=BATCH_CHUNK_RECORDS):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def process_batches(batch_function, function, records, size=BATCH_CHUNK_RECORDS, errors=None):
+    # Like process_records, but hands size records at a time to the script's _batch form. A
+    # chunk whose batch call raises is retried record by record with the scalar function, so
+    # only the records that fail on their own end up in errors.
+    for chunk in chunks(records, size):
+        try:
+            outputs = list(batch_function(chunk))
+            if len(outputs) != len(chunk):
+                raise ValueError(f"{batch_function.__name__} returned {len(outputs)} outputs for {len(chunk)} records")
+        except Exception as e:
+            if errors is None:
+                raise
+            logger.warning(f"Batch of {len(chunk)} records failed, processing them one at a time: {e}")
+            yield from process_records(function, chunk, errors)
+            continue
+        yield from outputs
+
+
+def run(function, batch_function=None, argv=None):
+    # Command line entry point of a generated script: streams records from a JSON lines file
+    # (or one JSON document) to a JSON lines file, stdin and stdout by default, so scripts
+    # chain with pipes: python a.py < input.jsonl | python b.py > output.jsonl
+    # With batch_function, records go through it in chunks instead of one call each.
+    parser = argparse.ArgumentParser(description=f"Apply {function.__name__} to every input record.")
+    parser.add_argument("input", nargs="?", default=STDIO, help="JSON lines or JSON input file, - for stdin.")
+    parser.add_argument("output", nargs="?", default=STDIO, help="JSON lines output file, - for stdout.")
+    parser.add_argument("--errors", help="Write records that raise to this JSON lines file and carry on with the rest.")
+    parser.add_argument("--chunk-size", type=int, default=BATCH_CHUNK_RECORDS, help="Records per call of the batch function.")
+    args = parser.parse_args(argv)
+
+    errors = [] if args.errors else None
+    records = read_records(args.input)
+    if batch_function is not None:
+        outputs = process_batches(batch_function, function, records, args.chunk_size, errors)
+    else:
+        outputs = process_records(function, records, errors)
+    count = write_records(outputs, args.output)
+    if errors:
+        script_name = os.path.basename(sys.argv[0])
+        write_records(({**error, "script_name": script_name} for error in errors), args.errors)
+        logger.warning(f"{len(errors)} of {count + len(errors)} records failed, see {args.errors}")
+    return count
@@ -0,0 +1,356 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import uuid4
+
+import script_generator
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_SERVER_WORKERS = 4
+FINISHED_STATUSES = {"passed", "failed", "error", "cancelled"}
+# job ids name the job's folder, so no dots (".." would leave the server's run folder)
+JOB_ID = re.compile(r"[A-Za-z0-9_-]+")
+JOB_PATH = re.compile(rf"^/jobs/({JOB_ID.pattern})(/result)?$")
+# a finished job evicts the LLM response cache at most this often
+CACHE_EVICT_INTERVAL_SECONDS = 600
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    def __init__(self, job_id, requirements, output_folder, max_attempts, candidates):
+        self.job_id = job_id
+        self.requirements = requirements
+        self.output_folder = output_folder
+        self.max_attempts = max_attempts
+        self.candidates = candidates
+        self.status = "queued"
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+
+    def status_report(self):
+        report = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "output_folder": self.output_folder,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.result is not None:
+            report["attempts"] = self.result["attempts"]
+            report["stage_seconds"] = self.result["stage_seconds"]
+        if self.error is not None:
+            report["error"] = self.error
+        return report
+
+
+class JobQueue:
+    # Runs generation jobs on a fixed set of worker threads that share the process-wide
+    # LLM client, rate limits, response cache and test runner. Every job gets its own
+    # output folder and log file; cancellation takes effect at the job's next LLM call,
+    # stage or repair attempt.
+    def __init__(self, folder, workers=DEFAULT_SERVER_WORKERS):
+        self.folder = folder
+        self.jobs = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._last_eviction = time.monotonic()
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, requirements, job_id=None, max_attempts=script_generator.DEFAULT_MAX_ATTEMPTS, candidates=script_generator.DEFAULT_CANDIDATES):
+        job_id = job_id or uuid4().hex[:12]
+        if not isinstance(job_id, str) or not JOB_ID.fullmatch(job_id):
+            raise ValueError(f"Job id {job_id!r} may only contain letters, digits, '_' and '-'")
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        if candidates < 1:
+            raise ValueError("candidates must be at least 1")
+        with self._lock:
+            if job_id in self.jobs:
+                raise ValueError(f"Job {job_id} already exists")
+            output_folder = script_generator.batch_job_folder({"job_id": job_id}, self.folder)
+            job = Job(job_id, requirements, output_folder, max_attempts, candidates)
+            self.jobs[job_id] = job
+        self._queue.put(job)
+        logger.info(f"Job {job_id} queued, {self._queue.qsize()} waiting")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def status_reports(self):
+        with self._lock:
+            return [job.status_report() for job in self.jobs.values()]
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATUSES:
+                return job
+            job.cancel_event.set()
+            if job.status == "queued":
+                # a worker that later takes it off the queue skips it
+                job.status = "cancelled"
+                job.finished_at = time.time()
+        logger.info(f"Job {job_id} cancellation requested")
+        return job
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            with self._lock:
+                if job.status != "queued":
+                    continue
+                job.status = "running"
+                job.started_at = time.time()
+            self._run(job)
+
+    def _run(self, job):
+        script_generator.request_priority.set(script_generator.PRIORITY_BATCH)
+        script_generator.current_cancel_event.set(job.cancel_event)
+        status, result, error = "error", None, None
+        try:
+            with script_generator.job_logging(job.output_folder):
+                result = script_generator.workflow(
+                    job.requirements, output_folder=job.output_folder, max_attempts=job.max_attempts, candidates=job.candidates
+                )
+            status = "passed" if result["passed"] else "failed"
+        except script_generator.JobCancelledError:
+            status = "cancelled"
+        except Exception as e:
+            logger.error(f"Job {job.job_id} raised an error", exc_info=True)
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            script_generator.current_cancel_event.set(None)
+        with self._lock:
+            job.status, job.result, job.error = status, result, error
+            job.finished_at = time.time()
+        logger.info(f"Job {job.job_id} finished with status {status} in {job.finished_at - job.started_at:.1f}s")
+        self._evict_cache()
+
+    def _evict_cache(self):
+        # the command line evicts when it exits; a server runs for days, so its jobs take turns
+        with self._lock:
+            if time.monotonic() - self._last_eviction < CACHE_EVICT_INTERVAL_SECONDS:
+                return
+            self._last_eviction = time.monotonic()
+        evicted = script_generator.response_cache.evict()
+        if evicted:
+            logger.info(f"Evicted {evicted} entries from the LLM response cache")
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {
+            "workers": len(self._threads),
+            "waiting": self._queue.qsize(),
+            "jobs": {status: statuses.count(status) for status in sorted(set(statuses))},
+        }
+
+    def close(self):
+        with self._lock:
+            for job in self.jobs.values():
+                job.cancel_event.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def read_result(job):
+    result = job.status_report()
+    final_script = os.path.join(job.output_folder, "final_script.py")
+    run_report = os.path.join(job.output_folder, script_generator.RUN_REPORT_FILE)
+    result["final_script"] = None
+    result["run_report"] = None
+    if os.path.exists(final_script):
+        with open(final_script, "r") as file:
+            result["final_script"] = file.read()
+    if os.path.exists(run_report):
+        with open(run_report, "r") as file:
+            result["run_report"] = json.load(file)
+    return result
+
+
+class GenerationRequestHandler(BaseHTTPRequestHandler):
+    # POST /jobs                 submit {"requirements", "job_id"?, "max_attempts"?, "candidates"?}
+    # GET /jobs                  status of every job
+    # GET /jobs/<id>             status of one job
+    # GET /jobs/<id>/result      final script and run report of a finished job
+    # DELETE /jobs/<id>          cancel a queued or running job
+    # GET /health                queue, rate limit and test runner figures
+    server_version = "ScriptGenerator/1.0"
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        jobs = self.server.jobs
+        if self.path == "/health":
+            health = jobs.stats()
+            if script_generator.test_runner is not None:
+                health["test_runner"] = script_generator.test_runner.metrics()
+            health["llm_retries"] = script_generator.request_scheduler.retries
+            health["llm_rate_limited"] = script_generator.request_scheduler.rate_limited
+            return self._send_json(200, health)
+        if self.path == "/jobs":
+            return self._send_json(200, {"jobs": jobs.status_reports()})
+        match = JOB_PATH.match(self.path)
+        job = jobs.get(match.group(1)) if match else None
+        if job is None:
+            return self._send_json(404, {"error": f"Unknown path or job: {self.path}"})
+        if not match.group(2):
+            return self._send_json(200, job.status_report())
+        if job.status not in FINISHED_STATUSES:
+            return self._send_json(409, {"error": f"Job {job.job_id} is still {job.status}", "status": job.status})
+        return self._send_json(200, read_result(job))
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            return self._send_json(404, {"error": f"Unknown path: {self.path}"})
+        try:
+            request = self._read_json()
+            requirements = request.get("requirements") or "\n\n".join(
+                part for part in (request.get("title", ""), request.get("body", "")) if part
+            )
+            if not requirements:
+                raise ValueError("The job has no requirements")
+            job = self.server.jobs.submit(
+                requirements,
+                job_id=request.get("job_id") or request.get("request_id"),
+                max_attempts=int(request.get("max_attempts", script_generator.DEFAULT_MAX_ATTEMPTS)),
+                candidates=int(request.get("candidates", script_generator.DEFAULT_CANDIDATES)),
+            )
+        except (ValueError, TypeError, AttributeError) as e:
+            return self._send_json(400, {"error": str(e)})
+        self._send_json(202, job.status_report())
+
+    def do_DELETE(self):
+        match = JOB_PATH.match(self.path)
+        job = self.server.jobs.cancel(match.group(1)) if match and not match.group(2) else None
+        if job is None:
+            return self._send_json(404, {"error": f"Unknown path or job: {self.path}"})
+        self._send_json(202, job.status_report())
+
+    def log_message(self, format, *args):
+        # request lines go to the server log; Unix socket clients have no address to print
+        logger.info(f"{self.command} {self.path} - " + format % args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(jobs, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, GenerationRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), GenerationRequestHandler)
+    server.jobs = jobs
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve script generation as a local JSON API with a job queue."
+    )
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on.")
+    parser.add_argument("--socket", help="Listen on this Unix socket instead of TCP.")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=DEFAULT_SERVER_WORKERS,
+        help="Number of jobs run at the same time.",
+    )
+    script_generator.add_test_runner_arguments(parser, default="pool")
+    parser.add_argument(
+        "--log-format",
+        choices=["text", "compact"],
+        default="text",
+        help="Log format of the server and its jobs (see script_generator.py --log-format).",
+    )
+    parser.add_argument(
+        "--log-max-mb",
+        type=float,
+        default=0,
+        help="Rotate a log file once it reaches this many megabytes (0 never rotates).",
+    )
+    parser.add_argument(
+        "--log-sample-rate",
+        type=float,
+        default=1.0,
+        help="With --log-format compact, fraction of prompts and responses stored in full.",
+    )
+    parser.add_argument("--rpm", type=int, help="Requests per minute allowed for each model.")
+    parser.add_argument("--tpm", type=int, help="Tokens per minute allowed for each model.")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    script_generator.check_test_runner_arguments(parser, args)
+
+    script_generator.log_settings.mode = args.log_format
+    script_generator.log_settings.max_bytes = int(args.log_max_mb * 1024 * 1024)
+    script_generator.log_settings.sample_rate = args.log_sample_rate
+    folder = script_generator.new_run_folder()
+    script_generator.configure_logging(folder)
+    if args.rpm:
+        script_generator.request_scheduler.limit_overrides["requests_per_minute"] = args.rpm
+    if args.tpm:
+        script_generator.request_scheduler.limit_overrides["tokens_per_minute"] = args.tpm
+    script_generator.set_test_runner(script_generator.test_runner_from_arguments(args))
+    # the client is built once, before the first job, and then shared by all of them
+    script_generator.get_client()
+
+    jobs = JobQueue(folder, workers=args.workers)
+    server = make_server(jobs, args.host, args.port, args.socket)
+    address = args.socket or f"http://{args.host}:{args.port}"
+    logger.info(f"Serving on {address}, jobs are written to {folder}")
+    print(f"Serving on {address}, jobs are written to {folder}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        jobs.close()
+        script_generator.set_test_runner(None)
+        script_generator.request_scheduler.log_stats()
+        script_generator.response_cache.log_stats()
+        script_generator.response_cache.evict()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import heapq
+import math
+import re
+import threading
+import zlib
+from collections import Counter, defaultdict
+
+from artifact_store import normalize_spec
+
+HASH_FEATURES = 2 ** 20
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+DEFAULT_K = 2
+DEFAULT_MIN_SCORE = 0.3
+
+
+def _stem(word):
+    # just enough to match "number"/"numbers" and "value"/"values"
+    return word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+
+
+def spec_features(text):
+    # hashed word unigrams and bigrams, stable across processes (unlike hash())
+    words = [_stem(word) for word in TOKEN_PATTERN.findall(normalize_spec(text))]
+    grams = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+    return Counter(zlib.crc32(gram.encode()) % HASH_FEATURES for gram in grams)
+
+
+def _log_tf(counts):
+    return {feature: 1 + math.log(count) for feature, count in counts.items()}
+
+
+def _normalized(weights):
+    norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+    return {feature: weight / norm for feature, weight in weights.items()} if norm else {}
+
+
+class SpecIndex:
+    # In-memory nearest-neighbour index over specifications using the lnc.ltc tf-idf scheme:
+    # documents get log tf and cosine normalisation, queries additionally get idf. Keeping
+    # idf out of the document vectors means adding a document never touches the others.
+    # Queries only visit the posting lists of their own features.
+    def __init__(self, k=DEFAULT_K, min_score=DEFAULT_MIN_SCORE):
+        self.k = k
+        self.min_score = min_score
+        self.loaded = False
+        self.documents = []
+        self.postings = defaultdict(list)
+        self.document_frequency = Counter()
+        self._keys = set()
+        self._lock = threading.Lock()
+
+    def add(self, text, payload, key=None):
+        # key (e.g. the spec hash) keeps one document per equivalent specification
+        weights = _normalized(_log_tf(spec_features(text)))
+        with self._lock:
+            if key is not None:
+                if key in self._keys:
+                    return False
+                self._keys.add(key)
+            document = len(self.documents)
+            self.documents.append(payload)
+            for feature, weight in weights.items():
+                self.postings[feature].append((document, weight))
+                self.document_frequency[feature] += 1
+        return True
+
+    def search(self, text, k=None, min_score=None):
+        k = self.k if k is None else k
+        min_score = self.min_score if min_score is None else min_score
+        counts = spec_features(text)
+        with self._lock:
+            total = len(self.documents)
+            query = _normalized({
+                feature: weight * math.log((total + 1) / self.document_frequency[feature])
+                for feature, weight in _log_tf(counts).items()
+                if self.document_frequency[feature]
+            })
+            scores = defaultdict(float)
+            for feature, query_weight in query.items():
+                for document, weight in self.postings[feature]:
+                    scores[document] += query_weight * weight
+            best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+            return [
+                {**self.documents[document], "score": round(score, 4)}
+                for document, score in best
+                if score >= min_score
+            ]
+
+    def __len__(self):
+        return len(self.documents)
@@ -0,0 +1,58 @@
+import logging
+import os
+import tempfile
+import unittest
+
+from compact_log import COMPACT_LOG_FILE, LogSettings, payload_extra, read_compact_log
+
+
+class TestCompactLogRoundTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        settings = LogSettings()
+        settings.mode = "compact"
+        self.handler = settings.handler(self.folder)
+        self.logger = logging.getLogger(f"test_compact_log_{id(self)}")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+    def log(self, label, payload):
+        self.logger.info("%s: %s", label, payload, extra=payload_extra(label, payload))
+
+    def read_payloads(self):
+        return [payload for _, _, _, payload in read_compact_log(os.path.join(self.folder, COMPACT_LOG_FILE))]
+
+    def test_growing_payload_resolves_at_every_step(self):
+        transcript = "Specification so far: " + "x" * 300
+        logged = []
+        for turn in range(5):
+            transcript += f"\nQuestion {turn}? Answer {turn}. " + "y" * 50
+            self.log("Gathering requirements", transcript)
+            logged.append(transcript)
+        self.assertEqual(self.read_payloads(), logged)
+
+    def test_unrelated_payloads_interleaved_with_growing_one(self):
+        first = "a" * 300
+        logged = [first, "b" * 300, first + "c" * 10, first + "c" * 20, first + "c" * 30]
+        self.log("Gathering requirements", logged[0])
+        self.log("Response", logged[1])
+        for payload in logged[2:]:
+            self.log("Gathering requirements", payload)
+        self.assertEqual(self.read_payloads(), logged)
+
+    def test_repeated_payload_is_read_back(self):
+        payload = "z" * 300
+        self.log("Prompt", payload)
+        self.log("Other", "w" * 300)
+        self.log("Prompt", payload)
+        self.assertEqual(self.read_payloads(), [payload, "w" * 300, payload])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import script_generator
+from artifact_store import ArtifactStore
+from spec_index import SpecIndex
+
+EXAMPLE_SCRIPT = """
+def add_numbers(input_data):
+    return {"sum": input_data["a"] + input_data["b"]}
+"""
+
+UNIT_TESTS = """
+import unittest
+from generated_script import add_numbers
+
+class TestAddNumbers(unittest.TestCase):
+    def test_sum(self):
+        self.assertEqual(add_numbers({"a": 2, "b": 3}), {"sum": 5})
+
+if __name__ == '__main__':
+    unittest.main()
+"""
+
+SPECIFICATION = "Add the numbers a and b and return their sum."
+
+
+class TestReuseSimilarScript(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.store = ArtifactStore(os.path.join(self.folder, "artifacts.sqlite3"))
+        self.addCleanup(self.store.close)
+        replaced = (("artifact_store", self.store), ("spec_index", SpecIndex()), ("test_runner", None), ("batch_benchmark_records", 0))
+        for target, value in replaced:
+            patcher = patch.object(script_generator, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_passing_example_is_saved_and_stored(self):
+        output_folder = os.path.join(self.folder, "run")
+        example = {"output_folder": "earlier_run", "score": 0.9, "specification": "Add a and b.", "script": EXAMPLE_SCRIPT}
+        generator = script_generator.ScriptGenerator(SPECIFICATION, {}, {}, UNIT_TESTS, output_folder, examples=[example])
+        self.assertTrue(generator.generate_passing_script(max_attempts=0))
+        self.assertEqual(generator.reused_from, "earlier_run")
+
+        generator.save_generated_script()
+        with open(os.path.join(output_folder, "final_script.py"), "r") as file:
+            self.assertEqual(file.read(), EXAMPLE_SCRIPT)
+
+        spec_gatherer = SimpleNamespace(specifications=SPECIFICATION, input_schema={}, output_schema={})
+        result = {"passed": True, "attempts": 0, "output_folder": output_folder, "stage_seconds": {}}
+        script_generator.record_artifacts(spec_gatherer, UNIT_TESTS, generator, result)
+        self.assertEqual(self.store.find_passing(SPECIFICATION)["final_script"], EXAMPLE_SCRIPT)
+
+
+    def test_similar_specification_finds_stored_script(self):
+        self.store.record(SPECIFICATION, "earlier_run", True, 1, {"final_script": EXAMPLE_SCRIPT})
+        self.store.record("Reverse the text of a string.", "other_run", True, 1, {"final_script": "def reverse(text): ..."})
+        examples = script_generator.find_similar_scripts("Add the numbers a and b, then return the sum.")
+        self.assertEqual([example["output_folder"] for example in examples], ["earlier_run"])
+        self.assertEqual(examples[0]["script"], EXAMPLE_SCRIPT)
+
+
+if __name__ == '__main__':
+    unittest.main()